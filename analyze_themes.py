@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+
+from pathlib import Path
+
+import numpy as np
+
+import kicad_color
+import theme_resolver
+from create_icon import ROOT_PATH, find_theme_json
+from migrate_to_v6 import KEY_MAP
+
+# WCAG 2 contrast ratio for large text and graphical objects
+DEFAULT_MIN_CONTRAST = 3.0
+# CIE76 delta E below which two colors are hard to tell apart
+DEFAULT_DUPLICATE_DELTA_E = 2.3
+
+# upper bound of the temporary arrays, the pairwise comparisons are computed in blocks of themes
+BLOCK_BYTES = 16 * 1024 * 1024
+
+# D65 white point
+LAB_WHITE = np.array([0.95047, 1.0, 1.08883])
+RGB_TO_XYZ = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+])
+
+
+def theme_files_of_repository():
+    theme_files = (find_theme_json(path) for path in theme_resolver.theme_dirs(ROOT_PATH))
+    return [theme_file for theme_file in theme_files if theme_file is not None]
+
+
+def key_vocabulary(palettes):
+    # every key KiCad 5 knew, extended by the keys the themes use on top of it
+    keys = set(KEY_MAP.values())
+    for palette in palettes:
+        keys.update(palette.keys)
+    return sorted(keys)
+
+
+def load_palettes(theme_files):
+    return [kicad_color.Palette.from_theme(theme_resolver.load_theme(theme_file)) for theme_file in theme_files]
+
+
+def palette_array(palettes, keys):
+    # returns a (themes x keys x 4) uint8 array and a (themes x keys) mask of the keys a theme defines
+    key_index = {key: i for i, key in enumerate(keys)}
+    packed = np.zeros((len(palettes), len(keys)), dtype=np.uint32)
+    present = np.zeros((len(palettes), len(keys)), dtype=bool)
+
+    for t, palette in enumerate(palettes):
+        columns = np.fromiter((key_index[key] for key in palette.keys), dtype=np.intp, count=len(palette))
+        packed[t, columns] = np.frombuffer(palette.colors, dtype=f"u{palette.colors.itemsize}")
+        present[t, columns] = True
+
+    shifts = np.array([24, 16, 8, 0], dtype=np.uint32)
+    colors = ((packed[..., None] >> shifts) & 0xFF).astype(np.uint8)
+    return colors, present
+
+
+def background_index(keys):
+    # index of the background of the section each key belongs to, -1 if the section has none
+    key_index = {key: i for i, key in enumerate(keys)}
+    return np.array([key_index.get(f"{key.split('.')[0]}.background", -1) for key in keys], dtype=np.intp)
+
+
+def composite(colors, background_colors):
+    # blends the colors with their alpha over the background, returns float RGB in 0 - 1
+    rgb = colors[..., :3].astype(np.float64) / 255
+    alpha = colors[..., 3:].astype(np.float64) / 255
+    background = background_colors[..., :3].astype(np.float64) / 255
+    return rgb * alpha + background * (1 - alpha)
+
+
+def linearize(rgb):
+    return np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+
+
+def relative_luminance(rgb):
+    return linearize(rgb) @ RGB_TO_XYZ[1]
+
+
+def to_lab(rgb):
+    xyz = (linearize(rgb) @ RGB_TO_XYZ.T) / LAB_WHITE
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    return np.stack([116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])], axis=-1)
+
+
+def contrast_ratios(colors, present, keys):
+    # (themes x keys) WCAG contrast of every layer against the background of its section, NaN if undefined
+    bg_index = background_index(keys)
+    has_background = bg_index >= 0
+    safe_index = np.where(has_background, bg_index, 0)
+
+    background_colors = colors[:, safe_index]
+    layer_luminance = relative_luminance(composite(colors, background_colors))
+    background_luminance = relative_luminance(composite(background_colors, background_colors))
+
+    lighter = np.maximum(layer_luminance, background_luminance)
+    darker = np.minimum(layer_luminance, background_luminance)
+    ratios = (lighter + 0.05) / (darker + 0.05)
+
+    valid = present & present[:, safe_index] & has_background & (bg_index != np.arange(len(keys)))
+    return np.where(valid, ratios, np.nan)
+
+
+def composited_lab(colors, present, keys):
+    bg_index = background_index(keys)
+    safe_index = np.where(bg_index >= 0, bg_index, np.arange(len(keys)))
+    return to_lab(composite(colors, colors[:, safe_index]))
+
+
+def rows_per_block(row_elements):
+    return max(1, BLOCK_BYTES // (row_elements * 8 * 3))
+
+
+def near_duplicates(lab, present, keys, threshold):
+    # (theme, key, key) indices of different keys of the same section with nearly identical colors
+    sections = np.array([key.split('.')[0] for key in keys])
+    candidates = np.triu(sections[:, None] == sections[None, :], k=1)
+
+    block_size = rows_per_block(len(keys) * len(keys))
+    pairs = []
+    for start in range(0, lab.shape[0], block_size):
+        stop = min(start + block_size, lab.shape[0])
+        block = lab[start:stop]
+        delta_e = np.linalg.norm(block[:, :, None, :] - block[:, None, :, :], axis=-1)
+        both_present = present[start:stop, :, None] & present[start:stop, None, :]
+        found = np.argwhere((delta_e < threshold) & both_present & candidates)
+        found[:, 0] += start
+        pairs.append(found)
+    return np.concatenate(pairs) if pairs else np.empty((0, 3), dtype=np.intp)
+
+
+def theme_distances(lab, present):
+    # (themes x themes) mean delta E over the keys both themes define
+    count = lab.shape[0]
+    lab = lab.astype(np.float32)
+    weights = present.astype(np.float32)
+    shared_count = weights @ weights.T
+
+    block_size = rows_per_block(count * lab.shape[1])
+    distances = np.empty((count, count))
+    for start in range(0, count, block_size):
+        stop = min(start + block_size, count)
+        difference = lab[start:stop, None] - lab[None, :]
+        delta_e = np.sqrt(np.einsum('abkc,abkc->abk', difference, difference))
+        distances[start:stop] = np.einsum('abk,ak,bk->ab', delta_e, weights[start:stop], weights)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return distances / shared_count
+
+
+def analyze(theme_files, min_contrast=DEFAULT_MIN_CONTRAST, duplicate_delta_e=DEFAULT_DUPLICATE_DELTA_E):
+    palettes = load_palettes(theme_files)
+    keys = key_vocabulary(palettes)
+    colors, present = palette_array(palettes, keys)
+
+    contrast = contrast_ratios(colors, present, keys)
+    lab = composited_lab(colors, present, keys)
+    duplicates = near_duplicates(lab, present, keys, duplicate_delta_e)
+    distances = theme_distances(lab, present)
+
+    themes = []
+    for t, theme_file in enumerate(theme_files):
+        low = np.flatnonzero(contrast[t] < min_contrast)
+        pairs = duplicates[duplicates[:, 0] == t, 1:]
+        themes.append({
+            "theme": str(theme_file.relative_to(ROOT_PATH) if theme_file.is_relative_to(ROOT_PATH) else theme_file),
+            "keys": int(present[t].sum()),
+            "min_contrast": None if np.all(np.isnan(contrast[t])) else round(float(np.nanmin(contrast[t])), 2),
+            "low_contrast": {keys[k]: round(float(contrast[t, k]), 2) for k in low},
+            "near_duplicates": [[keys[a], keys[b]] for a, b in pairs],
+        })
+
+    return {
+        "themes": themes,
+        # themes without a key in common have no distance
+        "distance": [[round(float(d), 2) if np.isfinite(d) else None for d in row] for row in distances],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Analyze contrast and similarity of color themes (requires numpy)')
+    parser.add_argument('theme_file', type=Path, nargs='*', help='Theme json files (default: all themes of this repository)')
+    parser.add_argument('-o', '--output', type=Path, help='Write the report as JSON to this file')
+    parser.add_argument('--min_contrast', type=float, default=DEFAULT_MIN_CONTRAST, help='Report layers with a lower contrast against the background')
+    parser.add_argument('--duplicate_delta_e', type=float, default=DEFAULT_DUPLICATE_DELTA_E, help='Report layer pairs with a lower delta E')
+
+    args = parser.parse_args()
+
+    theme_files = [theme_file.resolve() for theme_file in args.theme_file] or theme_files_of_repository()
+    report = analyze(theme_files, args.min_contrast, args.duplicate_delta_e)
+
+    if args.output:
+        with args.output.open("w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, allow_nan=False)
+        return
+
+    for theme in report["themes"]:
+        print(f"{theme['theme']}: {theme['keys']} colors, min contrast {theme['min_contrast']}, "
+              f"{len(theme['low_contrast'])} below {args.min_contrast}, {len(theme['near_duplicates'])} near duplicates")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+import os
+import shutil
+import tempfile
+
+# files are written into a temporary file next to them which replaces them in one step, so readers (KiCad,
+# other build processes, a web server) never see a partially written file
+
+
+def current_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# mkstemp creates files only readable by the owner, written files get the usual permissions instead
+FILE_MODE = 0o666 & ~current_umask()
+
+
+def write_file_atomic(path, data, keep_mode=False):
+    # keep_mode keeps the permissions of an existing file, e.g. of user settings
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        if keep_mode and path.exists():
+            shutil.copymode(path, tmp_name)
+        else:
+            os.chmod(tmp_name, FILE_MODE)
+        os.replace(tmp_name, path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+import create_icon
+import create_repository
+import migrate_to_v6
+import patch
+import png_writer
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+DEFAULT_REPEAT = 3
+# a benchmark is reported as regression if its median is this much slower than the baseline
+DEFAULT_MAX_REGRESSION = 1.25
+
+# lines of the synthetic KiCad config per theme, on top of the color keys
+CONFIG_LINES_PER_THEME = 20
+
+LEGACY_FILES = {
+    "eeschema": "schematic.",
+    "pcbnew": "board.",
+}
+
+# colors the icons need which KiCad 5 did not have, like hand maintained themes add them
+ICON_TABLES = {
+    "schematic": create_icon.EESCHEMA_REPLACEMENT_TABLE,
+    "board": create_icon.PCBNEW_REPLACEMENT_TABLE,
+}
+
+
+def random_color(rng):
+    red, green, blue = (rng.randrange(256) for _ in range(3))
+    if rng.random() < 0.2:
+        return f"rgba({red}, {green}, {blue}, {rng.choice([0.4, 0.6, 0.8]):.3f})"
+    return f"rgb({red}, {green}, {blue})"
+
+
+def solid_png(rgb, size=create_icon.ICON_PNG_SIZE):
+    return png_writer.encode_png(size, size, bytes(rgb) * (size * size))
+
+
+def write_legacy_scheme(theme_dir, rng):
+    for filename, prefix in LEGACY_FILES.items():
+        lines = [f"{key}={random_color(rng)}\n" for key, json_key in migrate_to_v6.KEY_MAP.items() if json_key.startswith(prefix)]
+        (theme_dir / filename).write_text("".join(lines))
+
+
+def write_metadata(theme_dir, name):
+    metadata = {
+        "$schema": "https://go.kicad.org/pcm/schemas/v1",
+        "name": f"Benchmark {name}",
+        "description": "Synthetic benchmark theme",
+        "description_full": "Synthetic benchmark theme.",
+        "identifier": f"com.github.pointhi.kicad-color-schemes.{name}",
+        "type": "colortheme",
+        "author": {"name": "benchmark", "contact": {"web": "https://github.com/pointhi/kicad-color-schemes"}},
+        "maintainer": {"name": "benchmark", "contact": {"web": "https://github.com/pointhi/kicad-color-schemes"}},
+        "license": "CC0-1.0",
+        "versions": [{"version": "1.0", "status": "stable", "kicad_version": "5.99"}],
+    }
+    with (theme_dir / create_repository.METADATA_FILEAME).open("w", encoding="utf-8") as f:
+        json.dump(metadata, f, indent=4)
+
+
+def generate_theme(root_path, index, rng):
+    name = f"benchmark-{index:05d}"
+    theme_dir = root_path / name
+    theme_dir.mkdir()
+
+    write_legacy_scheme(theme_dir, rng)
+    theme_json = migrate_to_v6.migrate_scheme(theme_dir, name, name, verbose=False)
+    for section, table in ICON_TABLES.items():
+        for key in table.values():
+            if key not in ("copper_f", "copper_b"):
+                theme_json[section].setdefault(key, random_color(rng))
+    migrate_to_v6.write_theme(theme_json, theme_dir / f"{name}.json")
+    write_metadata(theme_dir, name)
+    (theme_dir / create_repository.ICON_FILENAME).write_bytes(solid_png([rng.randrange(256) for _ in range(3)]))
+    return theme_dir
+
+
+def generate_repository(root_path, count, seed=0):
+    # theme directories as they exist in this repository: legacy files, theme json, metadata.json and icon.png
+    rng = random.Random(seed)
+    return [generate_theme(root_path, index, rng) for index in range(count)]
+
+
+def generate_config(config_path, line_count, seed=0):
+    # a KiCad 5 config with every color key the patches touch, padded with unrelated settings
+    rng = random.Random(seed)
+    lines = ["[General]\n"]
+    lines.extend(f"{key}={random_color(rng)}\n" for key in migrate_to_v6.KEY_MAP)
+    lines.extend(f"Setting{index}={rng.randrange(1 << 16)}\n" for index in range(max(0, line_count - len(lines))))
+    config_path.write_text("".join(lines))
+    return config_path
+
+
+@contextlib.contextmanager
+def repository_root(root_path):
+    # the tools work on the directory they live in, point them to the generated repository instead
+    saved = {name: getattr(create_repository, name) for name in ("ROOT_PATH", "RESOURCES_PATH", "PACKAGES_JSON_PATH", "BLOB_STORE_PATH")}
+    saved_migrate_root = migrate_to_v6.ROOT_PATH
+    create_repository.ROOT_PATH = root_path
+    for name in ("RESOURCES_PATH", "PACKAGES_JSON_PATH", "BLOB_STORE_PATH"):
+        setattr(create_repository, name, root_path / saved[name].name)
+    migrate_to_v6.ROOT_PATH = root_path
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(create_repository, name, value)
+        migrate_to_v6.ROOT_PATH = saved_migrate_root
+
+
+def measure(run, setup=None, repeat=DEFAULT_REPEAT):
+    # setup is called before every run and is not part of the measured time
+    runs = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            run()
+            runs.append(time.perf_counter() - start)
+    return {
+        "min": min(runs),
+        "median": statistics.median(runs),
+        "mean": statistics.fmean(runs),
+        "runs": runs,
+    }
+
+
+def package_paths(theme_dirs):
+    return [path for theme_dir in theme_dirs for path in theme_dir.glob("*_pcm.zip")]
+
+
+def benchmark_packages(theme_dirs, repeat):
+    def remove_packages():
+        for path in package_paths(theme_dirs):
+            path.unlink()
+
+    def create_all(package_cache=None):
+        for theme_dir in theme_dirs:
+            create_repository.create_and_get_pcm(theme_dir, package_cache)
+
+    package_cache = {}
+
+    def fill_package_cache():
+        if not package_cache:
+            create_all(package_cache)
+
+    return {
+        "create_and_get_pcm": measure(create_all, remove_packages, repeat),
+        # existing packages, sha256 and install size are hashed from the zips
+        "create_and_get_pcm_existing": measure(create_all, None, repeat),
+        # sha256 and install size are taken from the package cache
+        "create_and_get_pcm_cached": measure(lambda: create_all(package_cache), fill_package_cache, repeat),
+    }
+
+
+def benchmark_resources(theme_dirs, repeat):
+    resource_icons = [(f"com.github.pointhi.kicad-color-schemes.{theme_dir.name}", theme_dir / create_repository.ICON_FILENAME)
+                      for theme_dir in theme_dirs]
+    return {"write_resources_zip": measure(lambda: create_repository.write_resources_zip(resource_icons), None, repeat)}
+
+
+def benchmark_icons(theme_dirs, repeat):
+    themes = []
+    for theme_dir in theme_dirs:
+        with create_icon.find_theme_json(theme_dir).open("r") as f:
+            themes.append(json.load(f))
+    svg_data = create_icon.ICON_PCBNEW_SVG.read_text()
+
+    def render_all():
+        for theme_json in themes:
+            create_icon.replace_img(svg_data, theme_json, create_icon.PCBNEW_REPLACEMENT_TABLE, "board")
+
+    return {"replace_img": measure(render_all, None, repeat)}
+
+
+def benchmark_migrate(theme_dirs, repeat, jobs):
+    def migrate_main():
+        saved_argv = sys.argv
+        sys.argv = ["migrate_to_v6.py", "--all", "--force", "-j", str(jobs)]
+        try:
+            migrate_to_v6.main()
+        finally:
+            sys.argv = saved_argv
+
+    def migrate_schemes():
+        for theme_dir in theme_dirs:
+            migrate_to_v6.migrate_scheme(theme_dir, theme_dir.name, verbose=False)
+
+    return {
+        "migrate_main": measure(migrate_main, None, repeat),
+        "migrate_scheme": measure(migrate_schemes, None, repeat),
+    }
+
+
+def benchmark_patch(root_path, theme_dirs, repeat):
+    config_path = generate_config(root_path / "eeschema", len(theme_dirs) * CONFIG_LINES_PER_THEME)
+    patch_path = theme_dirs[0] / "eeschema"
+    config = patch.ConfigFile(config_path)
+    config.patch(patch_path)
+
+    def patch_config():
+        patch.ConfigFile(config_path).patch(patch_path)
+
+    return {
+        "config_patch": measure(patch_config, None, repeat),
+        "config_write": measure(config.write, None, repeat),
+    }
+
+
+def run_benchmarks(count, repeat, jobs):
+    with tempfile.TemporaryDirectory(prefix="kicad-color-schemes-benchmark-") as tmp:
+        root_path = Path(tmp).resolve()
+        generate_start = time.perf_counter()
+        theme_dirs = generate_repository(root_path, count)
+        print(f"* generated {count} themes in {time.perf_counter() - generate_start:.2f}s")
+
+        results = {}
+        with repository_root(root_path):
+            results.update(benchmark_packages(theme_dirs, repeat))
+            results.update(benchmark_resources(theme_dirs, repeat))
+            results.update(benchmark_icons(theme_dirs, repeat))
+            results.update(benchmark_migrate(theme_dirs, repeat, jobs))
+            results.update(benchmark_patch(root_path, theme_dirs, repeat))
+        return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=create_repository.ROOT_PATH, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline, max_regression):
+    # returns the benchmarks whose median got slower than max_regression times the baseline
+    baseline_medians = {(result["benchmark"], result["themes"]): result["median"] for result in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        previous = baseline_medians.get((result["benchmark"], result["themes"]))
+        if previous and result["median"] > previous * max_regression:
+            regressions.append((result, previous))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the repository tools on synthetic themes')
+    parser.add_argument('-n', '--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Numbers of generated themes')
+    parser.add_argument('-r', '--repeat', type=int, default=DEFAULT_REPEAT, help='Runs of every benchmark')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Number of processes used by migrate_to_v6.py')
+    parser.add_argument('-o', '--output', type=Path, help='Write the results as JSON to this file')
+    parser.add_argument('-b', '--baseline', type=Path, help='Results of an earlier run to compare against')
+    parser.add_argument('--max_regression', type=float, default=DEFAULT_MAX_REGRESSION,
+                        help='Fail if a median is this many times slower than the baseline')
+
+    args = parser.parse_args()
+
+    report = {
+        "created": datetime.datetime.now(tz=datetime.timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "results": [],
+    }
+
+    for count in args.sizes:
+        for name, result in run_benchmarks(count, max(1, args.repeat), max(1, args.jobs)).items():
+            report["results"].append({"benchmark": name, "themes": count, **result})
+            print(f"  {name:<28} {count:>6} themes  {result['median'] * 1000:10.1f} ms")
+
+    if args.output:
+        with args.output.open("w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with args.baseline.open("rb") as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+        for result, previous in regressions:
+            print(f"regression: {result['benchmark']} at {result['themes']} themes: "
+                  f"{previous * 1000:.1f} ms -> {result['median'] * 1000:.1f} ms")
+        if regressions:
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
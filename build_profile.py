@@ -0,0 +1,143 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+# opt-in instrumentation of the build, spans are recorded as complete events of the Chrome trace format
+# (chrome://tracing, https://ui.perfetto.dev) and summed up per stage for --profile
+
+COUNTERS = ("bytes_read", "bytes_written", "cache_hits", "cache_misses")
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.local = threading.local()
+
+    def stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+
+TRACER = Tracer()
+
+
+def enable():
+    TRACER.enabled = True
+
+
+@contextlib.contextmanager
+def record(name, category, args):
+    stack = TRACER.stack()
+    stack.append(args)
+    start = time.perf_counter_ns()
+    try:
+        yield args
+    finally:
+        end = time.perf_counter_ns()
+        stack.pop()
+        TRACER.events.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start / 1000,
+            "dur": (end - start) / 1000,
+            "pid": os.getpid(),
+            "tid": threading.get_native_id(),
+            "args": args,
+        })
+
+
+def span(name, category="build", **args):
+    # context manager timing a stage, does nothing unless the tracer is enabled
+    if not TRACER.enabled:
+        return contextlib.nullcontext()
+    return record(name, category, args)
+
+
+def count(**counters):
+    # adds to the counters of the innermost span
+    if not TRACER.enabled:
+        return
+    stack = TRACER.stack()
+    if not stack:
+        return
+    for key, value in counters.items():
+        stack[-1][key] = stack[-1].get(key, 0) + value
+
+
+def cache(hit):
+    count(**{"cache_hits" if hit else "cache_misses": 1})
+
+
+class CountingReader:
+    # file wrapper counting the bytes actually read, e.g. by ZipFile which only reads the central directory
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.fp.seek(offset, whence)
+
+    def tell(self):
+        return self.fp.tell()
+
+    def seekable(self):
+        return True
+
+
+def call_traced(enabled, function, *args):
+    # runs function in a worker process and returns its result together with the events recorded there
+    TRACER.enabled = enabled
+    TRACER.events = []
+    result = function(*args)
+    events, TRACER.events = TRACER.events, []
+    return result, events
+
+
+def add_events(events):
+    TRACER.events.extend(events)
+
+
+def write_trace(path):
+    process_names = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "main" if pid == os.getpid() else "worker"}}
+                     for pid in sorted({event["pid"] for event in TRACER.events})]
+    with path.open("w", encoding="utf-8") as f:
+        json.dump({"traceEvents": process_names + TRACER.events, "displayTimeUnit": "ms"}, f)
+
+
+def summary():
+    # calls, wall time and counters per stage, wall time per theme
+    stages = {}
+    themes = {}
+    for event in TRACER.events:
+        stage = stages.setdefault(event["name"], {"calls": 0, "seconds": 0.0, **dict.fromkeys(COUNTERS, 0)})
+        stage["calls"] += 1
+        stage["seconds"] += event["dur"] / 1e6
+        for key in COUNTERS:
+            stage[key] += event["args"].get(key, 0)
+        if event["name"] == "build_theme":
+            themes[event["args"]["theme"]] = event["dur"] / 1e6
+    return stages, themes
+
+
+def print_profile(slowest=10):
+    stages, themes = summary()
+    print(f"{'stage':<24} {'calls':>6} {'seconds':>9} {'read':>12} {'written':>12} {'hits':>6} {'misses':>6}")
+    for name, stage in sorted(stages.items(), key=lambda item: -item[1]["seconds"]):
+        print(f"{name:<24} {stage['calls']:>6} {stage['seconds']:>9.3f} {stage['bytes_read']:>12} "
+              f"{stage['bytes_written']:>12} {stage['cache_hits']:>6} {stage['cache_misses']:>6}")
+
+    if themes:
+        print("slowest themes:")
+        for theme, seconds in sorted(themes.items(), key=lambda item: -item[1])[:slowest]:
+            print(f"  {theme:<30} {seconds:.3f}s")
@@ -1,15 +1,30 @@
 #!/usr/bin/env python3
 
 import argparse
-import json
+import functools
+import hashlib
 import re
 
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+try:
+    import cairosvg
+except (ImportError, OSError):
+    # OSError is raised when cairosvg is installed, but the cairo library is missing
+    cairosvg = None
+
+import atomic_file
+import kicad_color
+import theme_resolver
+from theme_resolver import find_theme_json
+
 ROOT_PATH = Path(__file__).resolve().parent
 ICON_EESCHEMA_SVG = ROOT_PATH / "icon_sch_base.svg"
 ICON_PCBNEW_SVG = ROOT_PATH / "icon_pcb_base.svg"
-METADATA_FILEAME = "metadata.json"
+ICON_CACHE_PATH = ROOT_PATH / ".icon_cache"
+ICON_PNG_FILENAME = "icon.png"
+ICON_PNG_SIZE = 64
 
 EESCHEMA_REPLACEMENT_TABLE = {
     "#d0c5ac": "background",
@@ -36,78 +51,235 @@ PCBNEW_REPLACEMENT_TABLE = {
 }
 
 
-def parse_color(kicad_color):
-    match = re.match(r"\s*rgb\s*\(\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*\)", kicad_color)
-    if match:
-        red, green, blue = match.groups()
-    else:
-        match = re.match(r"\s*rgba\s*\(\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+.\d+)\s*\)", kicad_color)
-        if not match:
-            print(f"cannot parse color {kicad_color}")
-            exit(1)
-        red, green, blue, alpha = match.groups()
-    return int(red), int(green), int(blue)
+def theme_colors(theme_json, theme_key):
+    colors = dict(theme_json[theme_key])
+    if 'copper' in colors:
+        # small hack
+        colors['copper_f'] = colors['copper']['f']
+        colors['copper_b'] = colors['copper']['b']
+    return colors
+
+
+class IconTemplate:
+    # base svg split once into literal chunks and color slots, so every theme only fills in the slots
+
+    def __init__(self, data, replacement_table):
+        lookup = {orig_color.lower(): replacement for orig_color, replacement in replacement_table.items()}
+        pattern = "|".join(re.escape(orig_color) for orig_color in sorted(lookup, key=len, reverse=True))
+        parts = re.split(f"({pattern})", data, flags=re.IGNORECASE)
+
+        self.chunks = parts[0::2]
+        self.slots = [lookup[orig_color.lower()] for orig_color in parts[1::2]]
+        self.keys = sorted(set(self.slots))
+        self.sha256 = hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def replacement_colors(self, colors):
+        replacement_colors = {}
+        for key in self.keys:
+            replacement_colors[key] = kicad_color.to_hex(kicad_color.parse_color(colors[key]))
+        return replacement_colors
+
+    def palette_sha256(self, colors):
+        # identifies the rendered icon by template and the colors filled into it
+        palette = self.replacement_colors(colors)
+        palette_str = ";".join(f"{key}={palette[key]}" for key in self.keys)
+        return hashlib.sha256(f"{self.sha256};{palette_str}".encode("utf-8")).hexdigest()
+
+    def render(self, colors):
+        replacement_colors = self.replacement_colors(colors)
+
+        result = [self.chunks[0]]
+        for slot, chunk in zip(self.slots, self.chunks[1:]):
+            result.append(replacement_colors[slot])
+            result.append(chunk)
+        return "".join(result)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_template(data, replacement_items):
+    return IconTemplate(data, dict(replacement_items))
 
 
 def replace_img(data, theme_json, replacement_table, theme_key):
-    result_data = data
-    for orig_color, replacement in replacement_table.items():
-        if 'copper' in theme_json[theme_key]:
-            # small hack
-            theme_json[theme_key]['copper_f'] = theme_json[theme_key]['copper']['f']
-            theme_json[theme_key]['copper_b'] = theme_json[theme_key]['copper']['b']
+    template = compile_template(data, tuple(replacement_table.items()))
+    return template.render(theme_colors(theme_json, theme_key))
 
-        replacement_str = theme_json[theme_key][replacement]
-        red, green, blue = parse_color(replacement_str)
-        replacement_color = f"#{red:02X}{green:02X}{blue:02X}"
-        replace_regex = re.compile(re.escape(orig_color), re.IGNORECASE)
-        result_data = replace_regex.sub(replacement_color, result_data)
-    return result_data
 
+# theme key, base svg, replacement table and resulting icon filename
+ICONS = [
+    ('schematic', ICON_EESCHEMA_SVG, EESCHEMA_REPLACEMENT_TABLE, "icon_sch.svg"),
+    ('board', ICON_PCBNEW_SVG, PCBNEW_REPLACEMENT_TABLE, "icon_brd.svg"),
+]
 
-def main():
-    parser = argparse.ArgumentParser(description='Create SVG icon applied by color scheme')
-    parser.add_argument('theme_dir', type=str)
 
-    args = parser.parse_args()
+@functools.lru_cache(maxsize=None)
+def load_template(base_svg):
+    for _, icon_base_svg, replacement_table, _ in ICONS:
+        if icon_base_svg == base_svg:
+            with base_svg.open("r") as f:
+                return IconTemplate(f.read(), replacement_table)
+    raise ValueError(f"{base_svg} is no icon template")
 
-    theme_dir = Path(args.theme_dir)
-    if not theme_dir.is_dir():
-        print(f"{theme_dir} is not a directory")
-        exit(1)
 
-    for theme_file in theme_dir.glob("*.json"):
-        if theme_file.name != METADATA_FILEAME:
-            with theme_file.open("r") as f:
-                print(f"found {theme_file}")
-                theme_json = json.load(f)
-                break
+def load_templates():
+    for _, base_svg, _, _ in ICONS:
+        load_template(base_svg)
+
+
+def is_up_to_date(icon_file, *source_files):
+    if not icon_file.exists():
+        return False
+    icon_mtime = icon_file.stat().st_mtime_ns
+    return all(icon_mtime > source_file.stat().st_mtime_ns for source_file in source_files)
+
+
+def rasterize_svg(svg_data):
+    return cairosvg.svg2png(bytestring=svg_data.encode("utf-8"),
+                            output_width=ICON_PNG_SIZE, output_height=ICON_PNG_SIZE)
+
+
+def create_png_icon(theme_dir, theme_json):
+    # the board icon also shows a schematic, so it is preferred over the schematic one
+    for theme_key, base_svg, _, _ in reversed(ICONS):
+        if theme_key not in theme_json:
+            continue
+
+        template = load_template(base_svg)
+        colors = theme_colors(theme_json, theme_key)
+        try:
+            palette_sha256 = template.palette_sha256(colors)
+            break
+        except KeyError as e:
+            print(f"cannot use {theme_key} for {ICON_PNG_FILENAME} of {theme_dir}, theme has no color {e}")
+        except ValueError as e:
+            print(f"cannot use {theme_key} for {ICON_PNG_FILENAME} of {theme_dir}, {e}")
     else:
+        return None
+
+    cached_png = ICON_CACHE_PATH / f"{palette_sha256}.png"
+    if cached_png.exists():
+        png_data = cached_png.read_bytes()
+    else:
+        png_data = rasterize_svg(template.render(colors))
+        ICON_CACHE_PATH.mkdir(exist_ok=True)
+        # workers rendering the same palette at the same time must not see a partial file
+        atomic_file.write_file_atomic(cached_png, png_data)
+
+    png_file = theme_dir / ICON_PNG_FILENAME
+    if png_file.exists() and png_file.read_bytes() == png_data:
+        png_file.touch()
+        return None
+
+    print(f'create {ICON_PNG_FILENAME} for {theme_dir}')
+    atomic_file.write_file_atomic(png_file, png_data)
+    return png_file
+
+
+def create_icons(theme_dir, force=False, png=False):
+    # returns the list of icons which were (re)created
+    theme_file = find_theme_json(theme_dir)
+    if theme_file is None:
         print(f"no .json found in {theme_dir}")
-        exit(1)
+        return None
+
+    created = []
+    theme_json = None
+    try:
+        # a theme which is based on another one is outdated when its base changes as well
+        theme_files = theme_resolver.theme_chain(theme_file)
+    except ValueError as e:
+        print(f"cannot load {theme_file}, {e}")
+        return None
+
+    def load_theme_json():
+        print(f"found {theme_file}")
+        return theme_resolver.load_theme(theme_file)
+
+    for theme_key, base_svg, _, icon_filename in ICONS:
+        icon_file = theme_dir / icon_filename
+        if not force and is_up_to_date(icon_file, *theme_files, base_svg):
+            continue
+
+        if theme_json is None:
+            theme_json = load_theme_json()
+
+        if theme_key not in theme_json:
+            continue
+
+        print(f'create {theme_key} icon for {theme_dir}')
+        try:
+            svg_data = load_template(base_svg).render(theme_colors(theme_json, theme_key))
+        except KeyError as e:
+            print(f"cannot create {theme_key} icon, {theme_file} has no color {e}")
+            continue
+        except ValueError as e:
+            print(f"cannot create {theme_key} icon, {e}")
+            continue
+
+        atomic_file.write_file_atomic(icon_file, svg_data.encode("utf-8"))
+        created.append(icon_file)
+
+    base_svgs = [base_svg for _, base_svg, _, _ in ICONS]
+    if png and (force or not is_up_to_date(theme_dir / ICON_PNG_FILENAME, *theme_files, *base_svgs)):
+        if theme_json is None:
+            theme_json = load_theme_json()
+        png_file = create_png_icon(theme_dir, theme_json)
+        if png_file:
+            created.append(png_file)
+
+    return created
+
 
-    if 'schematic' in theme_json:
-        print('create schematic icon')
-        with ICON_EESCHEMA_SVG.open("r") as f:
-            svg_data = f.read()
+def create_all_icons(theme_dirs, jobs=1, force=False, png=False):
+    theme_dirs = [theme_dir for theme_dir in theme_dirs if find_theme_json(theme_dir) is not None]
 
-        svg_data = replace_img(svg_data, theme_json, EESCHEMA_REPLACEMENT_TABLE, 'schematic')
+    # parse the templates before forking, so workers do not need to do it again
+    load_templates()
 
-        icon_file = theme_dir / "icon_sch.svg"
-        with icon_file.open("w") as f:
-            f.write(svg_data)
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=load_templates) as executor:
+            results = list(executor.map(create_icons, theme_dirs, [force] * len(theme_dirs), [png] * len(theme_dirs)))
+    else:
+        results = [create_icons(theme_dir, force, png) for theme_dir in theme_dirs]
+
+    return {theme_dir: created for theme_dir, created in zip(theme_dirs, results)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create SVG icon applied by color scheme')
+    parser.add_argument('theme_dir', type=str, nargs='*')
+    parser.add_argument('--all', action='store_true', help='Create icons for all themes of this repository')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes used to create icons')
+    parser.add_argument('--force', action='store_true', help='Recreate icons even if they are up to date')
+    parser.add_argument('--png', action='store_true', help=f'Also rasterize the {ICON_PNG_FILENAME} used by the PCM')
+
+    args = parser.parse_args()
+
+    if args.png and cairosvg is None:
+        print(f"cairosvg is required to create {ICON_PNG_FILENAME} (pip install cairosvg)")
+        exit(1)
+
+    if args.all:
+        theme_dirs = theme_resolver.theme_dirs(ROOT_PATH)
+        create_all_icons(theme_dirs, max(1, args.jobs), args.force, args.png)
+        return
 
-    if 'board' in theme_json:
-        print('create board icon')
-        with ICON_PCBNEW_SVG.open("r") as f:
-            svg_data = f.read()
+    if not args.theme_dir:
+        parser.error("either a theme_dir or --all is required")
 
-        svg_data = replace_img(svg_data, theme_json, PCBNEW_REPLACEMENT_TABLE, 'board')
+    theme_dirs = [Path(theme_dir) for theme_dir in args.theme_dir]
+    for theme_dir in theme_dirs:
+        if not theme_dir.is_dir():
+            print(f"{theme_dir} is not a directory")
+            exit(1)
+
+    if len(theme_dirs) == 1:
+        if create_icons(theme_dirs[0], args.force, args.png) is None:
+            exit(1)
+        return
 
-        icon_file = theme_dir / "icon_brd.svg"
-        with icon_file.open("w") as f:
-            f.write(svg_data)
+    create_all_icons(theme_dirs, max(1, args.jobs), args.force, args.png)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
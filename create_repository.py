@@ -1,17 +1,37 @@
 #!/usr/bin/env python3
 
+import argparse
 import datetime
+import gzip
 import hashlib
+import io
 import json
+import os
+import struct
+import tempfile
+import time
 import zipfile
+import zlib
 
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from zipfile import ZipFile
 
+import atomic_file
+import build_profile
+import create_icon
+import theme_resolver
+import theme_watcher
+import validate_themes
+
 ROOT_PATH = Path(__file__).resolve().parent
 PACKAGES_JSON_PATH = ROOT_PATH / "packages.json"
 RESOURCES_PATH = ROOT_PATH / "resources.zip"
 REPOSITORY_JSON_PATH = ROOT_PATH / "repository.json"
+PACKAGE_SHARDS_PATH = ROOT_PATH / theme_resolver.PACKAGE_SHARDS_DIRNAME
+MANIFEST_PATH = ROOT_PATH / ".build_manifest.json"
+PACKAGE_CACHE_PATH = ROOT_PATH / ".package_cache.json"
+BLOB_STORE_PATH = ROOT_PATH / ".blob_store"
 METADATA_FILEAME = "metadata.json"
 ICON_FILENAME = "icon.png"
 
@@ -19,51 +39,341 @@ REPOSITORY_BASE_URI = "https://raw.githubusercontent.com/pointhi/kicad-color-sch
 
 READ_SIZE = 65536
 
+STALE_POLICIES = ['warn', 'fail', 'ignore']
+
+# quiet time after the last change before --watch rebuilds
+WATCH_DEBOUNCE_MS = 50
+
+
+# fixed zip entry attributes, so identical content always results in an identical package
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+ZIP_EXTERNAL_ATTR = 0o100644 << 16
+# zipfile ignores the compresslevel of the archive for ZipInfo entries, so all packages were deflated with the
+# zlib default, keep it so identical content still results in identical packages
+ZIP_COMPRESS_LEVEL = zlib.Z_DEFAULT_COMPRESSION
+ZIP_VERSION = 20
+ZIP_CREATE_SYSTEM = 3
+# sizes and CRC follow the data in a data descriptor, like zipfile writes them into a non-seekable stream
+ZIP_FLAGS = 0x08
+ZIP_UTF8_FLAG = 0x800
+
+ZIP_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+ZIP_DATA_DESCRIPTOR = struct.Struct("<4sLLL")
+ZIP_CENTRAL_DIRECTORY = struct.Struct("<4s4B4HL2L5H2L")
+ZIP_END_OF_CENTRAL_DIRECTORY = struct.Struct("<4s4H2LH")
+
 
 def sha256_of_file(path):
     file_hash = hashlib.sha256()
 
-    with path.open("rb") as f:
+    with build_profile.span("sha256_of_file", "io", file=path.name), path.open("rb") as f:
         data = f.read(READ_SIZE)
         while data:
             file_hash.update(data)
+            build_profile.count(bytes_read=len(data))
             data = f.read(READ_SIZE)
 
     return file_hash.hexdigest()
 
 
+class HashingWriter:
+    # write-only stream which hashes everything passing through it
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return self.fp.write(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        self.fp.flush()
+
+
+def pcm_entries_of_color_scheme(path):
+    entries = []
+    for json_file in path.glob("*.json"):
+        if json_file.name == METADATA_FILEAME:
+            entries.append((json_file.name, json_file))
+            continue
+        entries.append((f"colors/{json_file.name}", json_file))
+
+    icon_file = path / ICON_FILENAME
+    if icon_file.exists():
+        entries.append((f"resources/{ICON_FILENAME}", icon_file))
+
+    return sorted(entries)
+
+
+def deflate(data):
+    compressor = zlib.compressobj(ZIP_COMPRESS_LEVEL, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+def blob_matches(compressed, crc, size):
+    # a stored blob may be truncated or corrupt, it is only used if it inflates to the expected content
+    try:
+        data = zlib.decompress(compressed, -15)
+    except zlib.error:
+        return False
+    return len(data) == size and zlib.crc32(data) == crc
+
+
+class BlobStore:
+    # deflated zip entries keyed by the sha256 of their content, shared by all packages, versions and resources.zip,
+    # and the list of entries of every package built, so a package can be assembled again without its sources
+
+    def __init__(self, path):
+        self.path = path
+
+    def blob_path(self, sha256):
+        return self.path / "blobs" / sha256[:2] / sha256
+
+    def recipe_path(self, pkg_name):
+        return self.path / "packages" / f"{pkg_name}.json"
+
+    def deflated(self, data, sha256, crc):
+        blob_path = self.blob_path(sha256)
+        try:
+            compressed = blob_path.read_bytes()
+        except FileNotFoundError:
+            compressed = None
+        if compressed is not None and blob_matches(compressed, crc, len(data)):
+            build_profile.cache(hit=True)
+            return compressed
+        build_profile.cache(hit=False)
+
+        compressed = deflate(data)
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        write_file_atomic(blob_path, compressed)
+        return compressed
+
+    def write_recipe(self, pkg_name, sha256, members):
+        recipe = {
+            "sha256": sha256,
+            "entries": [{"name": name, "sha256": entry_sha256, "crc": crc, "size": size}
+                        for name, entry_sha256, crc, size, _ in members],
+        }
+        recipe_path = self.recipe_path(pkg_name)
+        recipe_path.parent.mkdir(parents=True, exist_ok=True)
+        write_file_atomic(recipe_path, json.dumps(recipe, indent=4).encode("utf-8"))
+
+    def load_recipe(self, pkg_name):
+        # returns the package sha256 and its members, None if the package or one of its entries is not stored
+        try:
+            with self.recipe_path(pkg_name).open("rb") as f:
+                recipe = json.load(f)
+            members = [(entry["name"], entry["sha256"], entry["crc"], entry["size"], self.blob_path(entry["sha256"]).read_bytes())
+                       for entry in recipe["entries"]]
+        except (OSError, ValueError, KeyError):
+            return None
+        return recipe["sha256"], members
+
+
+def entry_data(arcname, source_file):
+    # themes based on another theme are packaged resolved, KiCad does not know about bases
+    if arcname.startswith("colors/"):
+        return theme_resolver.theme_data(source_file)
+    return source_file.read_bytes()
+
+
+def zip_members(entries, blob_store=None):
+    # returns (arcname, sha256, crc, size, deflated data) of every entry, deflated data is taken from the blob store if possible
+    members = []
+    for arcname, source_file in entries:
+        data = entry_data(arcname, source_file)
+        build_profile.count(bytes_read=len(data))
+        sha256 = hashlib.sha256(data).hexdigest()
+        crc = zlib.crc32(data)
+        compressed = blob_store.deflated(data, sha256, crc) if blob_store is not None else deflate(data)
+        members.append((arcname, sha256, crc, len(data), compressed))
+    return members
+
+
+def encode_zip_name(arcname):
+    try:
+        return arcname.encode("ascii"), ZIP_FLAGS
+    except UnicodeEncodeError:
+        return arcname.encode("utf-8"), ZIP_FLAGS | ZIP_UTF8_FLAG
+
+
+def write_zip_members(fp, members):
+    # writes already deflated members, laid out like zipfile writes a deflated archive into a stream
+    dostime = ZIP_DATE_TIME[3] << 11 | ZIP_DATE_TIME[4] << 5 | ZIP_DATE_TIME[5] // 2
+    dosdate = (ZIP_DATE_TIME[0] - 1980) << 9 | ZIP_DATE_TIME[1] << 5 | ZIP_DATE_TIME[2]
+
+    offset = 0
+    central_directory = []
+    for arcname, _, crc, size, compressed in members:
+        if size > 0xFFFFFFFF or offset > 0xFFFFFFFF:
+            raise ValueError(f"{arcname} would require zip64")
+        name, flags = encode_zip_name(arcname)
+        header = ZIP_LOCAL_HEADER.pack(b"PK\x03\x04", ZIP_VERSION, 0, flags, zipfile.ZIP_DEFLATED, dostime, dosdate,
+                                       0, 0, 0, len(name), 0)
+        descriptor = ZIP_DATA_DESCRIPTOR.pack(b"PK\x07\x08", crc, len(compressed), size)
+        fp.write(header + name)
+        fp.write(compressed)
+        fp.write(descriptor)
+
+        central_directory.append(ZIP_CENTRAL_DIRECTORY.pack(
+            b"PK\x01\x02", ZIP_VERSION, ZIP_CREATE_SYSTEM, ZIP_VERSION, 0, flags, zipfile.ZIP_DEFLATED, dostime, dosdate,
+            crc, len(compressed), size, len(name), 0, 0, 0, 0, ZIP_EXTERNAL_ATTR, offset) + name)
+        offset += len(header) + len(name) + len(compressed) + len(descriptor)
+
+    central_directory = b"".join(central_directory)
+    fp.write(central_directory)
+    fp.write(ZIP_END_OF_CENTRAL_DIRECTORY.pack(b"PK\x05\x06", 0, 0, len(members), len(members),
+                                               len(central_directory), offset, 0))
+
+
+def write_zip_entries(fp, entries, blob_store=None):
+    # returns the install size of the entries
+    members = zip_members(entries, blob_store)
+    write_zip_members(fp, members)
+    return sum(member[3] for member in members)
+
+
+def write_reproducible_zip(members, resulting_file):
+    # the package is streamed into a temporary file through a hash, and only renamed when complete
+    fd, tmp_name = tempfile.mkstemp(dir=resulting_file.parent, prefix=f".{resulting_file.name}.", suffix=".tmp")
+    try:
+        with build_profile.span("write_reproducible_zip", "io", file=resulting_file.name), os.fdopen(fd, "wb") as f:
+            writer = HashingWriter(f)
+            write_zip_members(writer, members)
+            build_profile.count(bytes_written=writer.size)
+        os.chmod(tmp_name, atomic_file.FILE_MODE)
+        os.replace(tmp_name, resulting_file)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+    return {"sha256": writer.hash.hexdigest(), "size": writer.size, "install_size": sum(member[3] for member in members)}
+
+
+def write_file_atomic(path, data):
+    build_profile.count(bytes_written=len(data))
+    atomic_file.write_file_atomic(path, data)
+
+
 def create_pcm_from_color_scheme(path, resulting_file):
-    with ZipFile(resulting_file, 'w', compression=zipfile.ZIP_DEFLATED) as zip:
-        for json_file in path.glob("*.json"):
-            if json_file.name == METADATA_FILEAME:
-                zip.write(json_file, json_file.name)
-                continue
-            zip.write(json_file, f"colors/{json_file.name}")
+    blob_store = BlobStore(BLOB_STORE_PATH)
+    members = zip_members(pcm_entries_of_color_scheme(path), blob_store)
+    built = write_reproducible_zip(members, resulting_file)
+    blob_store.write_recipe(resulting_file.name, built["sha256"], members)
+    return built
 
-        icon_file = path / ICON_FILENAME
-        if icon_file.exists():
-            zip.write(icon_file, f"resources/{ICON_FILENAME}")
+
+def restore_pcm(resulting_file):
+    # assembles a package built earlier from the blob store, returns None if it is not stored
+    recipe = BlobStore(BLOB_STORE_PATH).load_recipe(resulting_file.name)
+    if recipe is None:
+        return None
+
+    sha256, members = recipe
+    if not all(blob_matches(compressed, crc, size) for _, _, crc, size, compressed in members):
+        print(f"  * corrupt blob store entry for: {resulting_file.name}")
+        return None
+    return write_reproducible_zip(members, resulting_file)
 
 
 def install_size_of_zip(zip_path):
     install_size = 0
-    with ZipFile(zip_path, 'r') as zip:
-        for file in zip.filelist:
-            install_size += zip.getinfo(file.filename).file_size
+    with build_profile.span("install_size_of_zip", "io", file=zip_path.name), zip_path.open("rb") as f:
+        reader = build_profile.CountingReader(f)
+        with ZipFile(reader, 'r') as zip:
+            for file in zip.filelist:
+                install_size += zip.getinfo(file.filename).file_size
+        build_profile.count(bytes_read=reader.bytes_read)
     return install_size
 
 
-def create_and_get_pcm(path):
+def cache_key_of_file(path):
+    return path.relative_to(ROOT_PATH).as_posix()
+
+
+def fingerprint_of_file(path):
+    stat = path.stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "inode": stat.st_ino}
+
+
+def store_package_info(pkg_path, sha256, install_size, package_cache=None):
+    entry = fingerprint_of_file(pkg_path)
+    entry["sha256"] = sha256
+    entry["install_size"] = install_size
+
+    if package_cache is not None:
+        package_cache[cache_key_of_file(pkg_path)] = entry
+    return entry
+
+
+def package_info(pkg_path, package_cache=None, verify=False):
+    # published packages never change, so sha256 and sizes are cached by path, size, mtime and inode
+    fingerprint = fingerprint_of_file(pkg_path)
+
+    key = cache_key_of_file(pkg_path)
+    cached = package_cache.get(key) if package_cache is not None else None
+    if cached and all(cached.get(k) == v for k, v in fingerprint.items()) and not verify:
+        build_profile.cache(hit=True)
+        return cached
+    build_profile.cache(hit=False)
+
+    entry = dict(fingerprint)
+    entry["sha256"] = sha256_of_file(pkg_path)
+    entry["install_size"] = install_size_of_zip(pkg_path)
+
+    if cached and verify and (cached.get("sha256"), cached.get("install_size")) != (entry["sha256"], entry["install_size"]):
+        print(f"  * cache mismatch for: {pkg_path}")
+
+    if package_cache is not None:
+        package_cache[key] = entry
+    return entry
+
+
+def load_package_cache():
+    if not PACKAGE_CACHE_PATH.exists():
+        return {}
+    try:
+        with PACKAGE_CACHE_PATH.open("rb") as f:
+            package_cache = json.load(f)
+    except ValueError:
+        package_cache = None
+    # an interrupted build of an older version may have left a truncated file
+    if not isinstance(package_cache, dict):
+        print(f"* ignore corrupt package cache: {PACKAGE_CACHE_PATH}")
+        return {}
+    return package_cache
+
+
+def write_package_cache(package_cache):
+    # evict entries of packages which do not exist anymore
+    package_cache = {key: entry for key, entry in package_cache.items() if (ROOT_PATH / key).exists()}
+
+    write_file_atomic(PACKAGE_CACHE_PATH, json.dumps(package_cache, indent=4, sort_keys=True).encode("utf-8"))
+
+
+def create_and_get_pcm(path, package_cache=None, verify=False, base_uri=REPOSITORY_BASE_URI):
     metadata_path = path / METADATA_FILEAME
     if not metadata_path.exists():
         return
 
+    with build_profile.span("create_and_get_pcm", theme=path.name):
+        return create_schema(path, metadata_path, package_cache, verify, base_uri)
+
+
+def create_schema(path, metadata_path, package_cache, verify, base_uri):
     print(f"* create schema for: {path}")
 
     with metadata_path.open("rb") as f:
         metadata_json = json.load(f)
 
     identifier = metadata_json["identifier"]
+    newest_version = max((v["version"] for v in metadata_json["versions"]), key=version_key)
 
     for metadata_version in metadata_json["versions"]:
         version = metadata_version['version']
@@ -71,50 +381,317 @@ def create_and_get_pcm(path):
         pkg_path = path / pkg_name
 
         if not pkg_path.exists():
-            # create new package as it does not exist yet (new version)
-            print(f"  * create package: {pkg_path}")
-            create_pcm_from_color_scheme(path, pkg_path)
+            # older versions were built from older sources, so they can only be restored from the blob store
+            built = restore_pcm(pkg_path) if version != newest_version else None
+            if built is not None:
+                print(f"  * restore package: {pkg_path}")
+            else:
+                # create new package as it does not exist yet (new version)
+                print(f"  * create package: {pkg_path}")
+                built = create_pcm_from_color_scheme(path, pkg_path)
+            pkg_info = store_package_info(pkg_path, built["sha256"], built["install_size"], package_cache)
+        else:
+            pkg_info = package_info(pkg_path, package_cache, verify)
 
         # fill in package data
-        metadata_version['download_sha256'] = sha256_of_file(pkg_path)
-        metadata_version['download_size'] = pkg_path.stat().st_size
-        metadata_version['download_url'] = f"{REPOSITORY_BASE_URI}/{path.name}/{pkg_name}"
-        metadata_version['install_size'] = install_size_of_zip(pkg_path)
+        metadata_version['download_sha256'] = pkg_info["sha256"]
+        metadata_version['download_size'] = pkg_info["size"]
+        metadata_version['download_url'] = f"{base_uri}/{path.name}/{pkg_name}"
+        metadata_version['install_size'] = pkg_info["install_size"]
 
     return metadata_json
 
 
-def write_packages_json(package_array):
-    packages_data = {"packages": package_array}
+def sha256_of_sources(path):
+    # hash of everything that ends up inside a package, used to skip unchanged themes
+    sources_hash = hashlib.sha256()
 
-    with PACKAGES_JSON_PATH.open("w", encoding="utf-8") as f:
-        json.dump(packages_data, f, indent=4)
+    source_files = sorted(path.glob("*.json"))
+    icon_file = path / ICON_FILENAME
+    if icon_file.exists():
+        source_files.append(icon_file)
 
+    for source_file in source_files:
+        sources_hash.update(source_file.name.encode("utf-8"))
+        sources_hash.update(b"\0")
+        sources_hash.update(sha256_of_file(source_file).encode("ascii"))
 
-def write_resources_zip():
-    with ZipFile(RESOURCES_PATH, 'w', compression=zipfile.ZIP_DEFLATED) as zip:
-        for path in ROOT_PATH.iterdir():
-            if not path.is_dir():
-                continue
+    # a theme based on another one changes with its base
+    for theme_file in source_files:
+        if theme_file.suffix != ".json" or theme_file.name == METADATA_FILEAME:
+            continue
+        try:
+            base_files = theme_resolver.theme_chain(theme_file)[1:]
+        except ValueError:
+            continue
+        for base_file in base_files:
+            sources_hash.update(f"{base_file.parent.name}/{base_file.name}".encode("utf-8"))
+            sources_hash.update(b"\0")
+            sources_hash.update(sha256_of_file(base_file).encode("ascii"))
+
+    return sources_hash.hexdigest()
+
+
+def package_paths_of_schema(path, schema):
+    identifier = schema["identifier"]
+    return [path / f"{identifier}_v{v['version']}_pcm.zip" for v in schema["versions"]]
+
+
+def package_fingerprints(path, schema):
+    return {pkg_path.name: fingerprint_of_file(pkg_path) for pkg_path in package_paths_of_schema(path, schema)}
 
-            metadata_path = path / METADATA_FILEAME
-            icon_path = path / ICON_FILENAME
-            if not metadata_path.exists() or not icon_path.exists():
-                continue
 
-            with metadata_path.open("r") as f:
-                metadata_json = json.load(f)
+def packages_unchanged(path, manifest_entry):
+    # the schema holds hashes and sizes of the packages, so it is only valid for exactly the files it was made of
+    try:
+        return package_fingerprints(path, manifest_entry["schema"]) == manifest_entry.get("packages")
+    except FileNotFoundError:
+        return False
 
-            identifier = metadata_json["identifier"]
 
-            zip.write(icon_path, f"{identifier}/{ICON_FILENAME}")
+def crc32_of_entry(arcname, source_file):
+    data = entry_data(arcname, source_file)
+    build_profile.count(bytes_read=len(data))
+    return zlib.crc32(data), len(data)
 
 
-def write_repository_json():
-    packages_json_sha256 = sha256_of_file(PACKAGES_JSON_PATH)
-    packages_json_update_timestamp = int(PACKAGES_JSON_PATH.stat().st_mtime)
-    packages_json_update_time_utc = datetime.datetime.fromtimestamp(packages_json_update_timestamp, tz=datetime.timezone.utc)
+def version_key(version):
+    return tuple(int(part) for part in version.split("."))
+
+
+def stale_files_of_theme(path):
+    # returns the newest published version and its files which differ from the current sources, None if it is up to date
+    metadata_path = path / METADATA_FILEAME
+    if not metadata_path.exists():
+        return None
+
+    with metadata_path.open("rb") as f:
+        metadata_json = json.load(f)
+    version = max((v["version"] for v in metadata_json["versions"]), key=version_key)
+    pkg_path = path / f"{metadata_json['identifier']}_v{version}_pcm.zip"
+    if not pkg_path.exists():
+        # not published yet, it will be built from the current sources
+        return None
+
+    with build_profile.span("stale_files_of_theme", theme=path.name):
+        # CRC32 and size are stored in the central directory, so nothing has to be decompressed
+        with ZipFile(pkg_path, 'r') as zip:
+            published = {info.filename: (info.CRC, info.file_size) for info in zip.infolist()}
+
+        stale = [arcname for arcname, source_file in pcm_entries_of_color_scheme(path)
+                 if published.pop(arcname, None) != crc32_of_entry(arcname, source_file)]
+        # files which are not part of the theme anymore
+        stale.extend(published)
+
+    return (version, sorted(stale)) if stale else None
+
+
+def find_stale_themes(theme_paths, jobs=1):
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(stale_files_of_theme, theme_paths))
+    else:
+        results = [stale_files_of_theme(path) for path in theme_paths]
+    return {path.name: result for path, result in zip(theme_paths, results) if result is not None}
+
+
+def print_stale_themes(stale_themes):
+    for name, (version, stale_files) in stale_themes.items():
+        print(f"* stale: {name} v{version} differs from {', '.join(stale_files)}, "
+              f"add a new version to {METADATA_FILEAME} to publish the changes")
+
+
+def load_manifest():
+    if not MANIFEST_PATH.exists():
+        return {}
+    try:
+        with MANIFEST_PATH.open("rb") as f:
+            manifest = json.load(f)
+    except ValueError:
+        manifest = None
+    # an interrupted build of an older version may have left a truncated file
+    if not isinstance(manifest, dict):
+        print(f"* ignore corrupt manifest: {MANIFEST_PATH}")
+        return {}
+    return manifest
+
+
+def write_manifest(manifest):
+    write_file_atomic(MANIFEST_PATH, json.dumps(manifest, indent=4).encode("utf-8"))
+
+
+def build_theme(path, manifest_entry=None, package_cache=None, verify=False, base_uri=REPOSITORY_BASE_URI):
+    # returns the manifest entry of a theme directory (or None if it is no package) and its package cache entries
+    if package_cache is None:
+        package_cache = {}
+
+    if not (path / METADATA_FILEAME).exists():
+        return None, package_cache
+
+    with build_profile.span("build_theme", theme=path.name):
+        sources_sha256 = sha256_of_sources(path)
+        if manifest_entry and manifest_entry["sources_sha256"] == sources_sha256 \
+                and manifest_entry.get("base_uri") == base_uri \
+                and packages_unchanged(path, manifest_entry) and not verify:
+            print(f"* unchanged: {path}")
+            build_profile.cache(hit=True)
+            return manifest_entry, package_cache
+
+        build_profile.cache(hit=False)
+        schema = create_and_get_pcm(path, package_cache, verify, base_uri)
+        return {"sources_sha256": sources_sha256, "base_uri": base_uri, "schema": schema,
+                "packages": package_fingerprints(path, schema)}, package_cache
+
+
+def build_all(theme_paths, manifest, package_cache, jobs=1, verify=False, base_uri=REPOSITORY_BASE_URI):
+    def theme_cache(path):
+        prefix = f"{path.name}/"
+        return {key: entry for key, entry in package_cache.items() if key.startswith(prefix)}
+
+    results = {}
+    if jobs > 1:
+        # the events recorded in the worker processes are sent back with the results
+        traced = build_profile.TRACER.enabled
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {path.name: executor.submit(build_profile.call_traced, traced, build_theme, path, manifest.get(path.name), theme_cache(path), verify, base_uri)
+                       for path in theme_paths}
+            for name, future in futures.items():
+                results[name], events = future.result()
+                build_profile.add_events(events)
+    else:
+        for path in theme_paths:
+            results[path.name] = build_theme(path, manifest.get(path.name), theme_cache(path), verify, base_uri)
+
+    entries = {}
+    for name, (entry, updated_cache) in results.items():
+        package_cache.update(updated_cache)
+        if entry:
+            entries[name] = entry
+    return entries
+
+
+def load_repository_json():
+    if not REPOSITORY_JSON_PATH.exists():
+        return {}
+    try:
+        with REPOSITORY_JSON_PATH.open("rb") as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def file_matches(path, data):
+    try:
+        return path.stat().st_size == len(data) and path.read_bytes() == data
+    except FileNotFoundError:
+        return False
+
+
+def file_index_entry(previous_entry, sha256, path, data):
+    # returns sha256 and update timestamp, which only change when the content does, and whether to write the file.
+    # The file on disk is checked as well, it may have been modified or replaced since the last build
+    if previous_entry and previous_entry.get("sha256") == sha256:
+        entry = {"sha256": sha256, "update_timestamp": previous_entry["update_timestamp"]}
+    else:
+        entry = {"sha256": sha256, "update_timestamp": int(time.time())}
+    return entry, not file_matches(path, data)
+
+
+def dump_json(data, compact=False):
+    if compact:
+        return json.dumps(data, separators=(",", ":")).encode("utf-8")
+    return json.dumps(data, indent=4).encode("utf-8")
+
+
+def write_gzip_sibling(path, data, precompress):
+    # precompressed copy for web servers, mtime=0 keeps it reproducible. It is compared with the file on disk,
+    # as path may be unchanged since an earlier build with precompress while the .gz is not. Without precompress
+    # an old .gz is removed, it would be served with content which does not match path anymore
+    gzip_path = path.with_name(path.name + ".gz")
+    if not precompress:
+        gzip_path.unlink(missing_ok=True)
+        return
+    gzip_data = gzip.compress(data, compresslevel=9, mtime=0)
+    if not file_matches(gzip_path, gzip_data):
+        write_file_atomic(gzip_path, gzip_data)
+
+
+def write_packages_json(package_array, previous_repository=None, compact=False, precompress=False):
+    packages_data = {"packages": package_array}
+    with build_profile.span("dump_json", file=PACKAGES_JSON_PATH.name):
+        data = dump_json(packages_data, compact)
+
+    with build_profile.span("write_packages_json"):
+        previous_entry = (previous_repository or {}).get("packages")
+        entry, changed = file_index_entry(previous_entry, hashlib.sha256(data).hexdigest(), PACKAGES_JSON_PATH, data)
+        build_profile.cache(hit=not changed)
+        if changed:
+            print(f"* write {PACKAGES_JSON_PATH.name}")
+            write_file_atomic(PACKAGES_JSON_PATH, data)
+        write_gzip_sibling(PACKAGES_JSON_PATH, data, precompress)
+    return entry
+
+
+def write_package_shards(package_array, compact=False, precompress=False, base_uri=REPOSITORY_BASE_URI):
+    # one file per package, so mirrors only fetch the packages which changed
+    PACKAGE_SHARDS_PATH.mkdir(exist_ok=True)
+
+    shards = []
+    for package in package_array:
+        shard_path = PACKAGE_SHARDS_PATH / f"{package['identifier']}.json"
+        data = dump_json(package, compact)
+        changed = not shard_path.exists() or shard_path.read_bytes() != data
+        build_profile.cache(hit=not changed)
+        if changed:
+            print(f"* write {shard_path.relative_to(ROOT_PATH)}")
+            write_file_atomic(shard_path, data)
+        write_gzip_sibling(shard_path, data, precompress)
+
+        shards.append({
+            "identifier": package["identifier"],
+            "sha256": hashlib.sha256(data).hexdigest(),
+            "url": f"{base_uri}/{PACKAGE_SHARDS_PATH.name}/{shard_path.name}"
+        })
+
+    # remove shards of packages which do not exist anymore
+    shard_names = {f"{package['identifier']}.json" for package in package_array}
+    for shard_path in PACKAGE_SHARDS_PATH.iterdir():
+        if shard_path.name.removesuffix(".gz") not in shard_names:
+            shard_path.unlink()
+
+    return shards
+
+
+def write_resources_zip(resource_icons, previous_repository=None):
+    # resource_icons are (identifier, icon path) pairs, resources.zip is built reproducibly in memory first
+    entries = sorted((f"{identifier}/{ICON_FILENAME}", icon_path) for identifier, icon_path in resource_icons if icon_path.exists())
+    if not entries:
+        return None
+
+    buffer = io.BytesIO()
+    writer = HashingWriter(buffer)
+    write_zip_entries(writer, entries, BlobStore(BLOB_STORE_PATH))
+
+    previous_entry = (previous_repository or {}).get("resources")
+    entry, changed = file_index_entry(previous_entry, writer.hash.hexdigest(), RESOURCES_PATH, buffer.getvalue())
+    build_profile.cache(hit=not changed)
+    if changed:
+        print(f"* write {RESOURCES_PATH.name}")
+        write_file_atomic(RESOURCES_PATH, buffer.getvalue())
+    return entry
+
+
+def repository_file_entry(entry, filename, base_uri=REPOSITORY_BASE_URI):
+    update_time_utc = datetime.datetime.fromtimestamp(entry["update_timestamp"], tz=datetime.timezone.utc)
+    return {
+        "sha256": entry["sha256"],
+        "update_time_utc": update_time_utc.strftime("%Y-%m-%d %H:%M:%S"),
+        "update_timestamp": entry["update_timestamp"],
+        "url": f"{base_uri}/{filename}"
+    }
 
+
+def write_repository_json(packages_entry, resources_entry=None, package_shards=None, base_uri=REPOSITORY_BASE_URI):
     repository_data = {
         "$schema": "https://go.kicad.org/pcm/schemas/v1#/definitions/Repository",
         "maintainer": {
@@ -124,40 +701,200 @@ def write_repository_json():
             "name": "Thomas Pointhuber"
         },
         "name": "kicad-color-schemes repository by @pointhi",
-        "packages": {
-            "sha256": packages_json_sha256,
-            "update_time_utc": packages_json_update_time_utc.strftime("%Y-%m-%d %H:%M:%S"),
-            "update_timestamp": packages_json_update_timestamp,
-            "url": f"{REPOSITORY_BASE_URI}/packages.json"
-        }
+        "packages": repository_file_entry(packages_entry, PACKAGES_JSON_PATH.name, base_uri)
     }
 
-    if RESOURCES_PATH.exists():
-        resources_sha256 = sha256_of_file(RESOURCES_PATH)
-        resources_update_timestamp = int(RESOURCES_PATH.stat().st_mtime)
-        resources_update_time_utc = datetime.datetime.fromtimestamp(resources_update_timestamp, tz=datetime.timezone.utc)
-        repository_data["resources"] = {
-            "sha256": resources_sha256,
-            "update_time_utc": resources_update_time_utc.strftime("%Y-%m-%d %H:%M:%S"),
-            "update_timestamp": resources_update_timestamp,
-            "url": f"{REPOSITORY_BASE_URI}/resources.zip"
-        }
+    if resources_entry is not None:
+        repository_data["resources"] = repository_file_entry(resources_entry, RESOURCES_PATH.name, base_uri)
 
-    with REPOSITORY_JSON_PATH.open("w", encoding="utf-8") as f:
-        json.dump(repository_data, f, indent=4)
+    if package_shards is not None:
+        repository_data["package_shards"] = package_shards
 
+    data = json.dumps(repository_data, indent=4).encode("utf-8")
+    unchanged = REPOSITORY_JSON_PATH.exists() and REPOSITORY_JSON_PATH.read_bytes() == data
+    build_profile.cache(hit=unchanged)
+    if unchanged:
+        return
+    print(f"* write {REPOSITORY_JSON_PATH.name}")
+    write_file_atomic(REPOSITORY_JSON_PATH, data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create the PCM repository out of all color schemes')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes used to build packages')
+    parser.add_argument('--force', action='store_true', help='Ignore the build manifest and rebuild all themes')
+    parser.add_argument('--verify', action='store_true', help='Recompute hashes and sizes of all packages instead of using the cache')
+    parser.add_argument('--icons', action='store_true', help='Create the icons of all themes before building packages')
+    parser.add_argument('--base_uri', type=str, default=os.environ.get("REPOSITORY_BASE_URI", REPOSITORY_BASE_URI),
+                        help='URI the repository is published at (default: $REPOSITORY_BASE_URI or GitHub)')
+    parser.add_argument('--compact', action='store_true', help='Write packages.json and shards without indentation')
+    parser.add_argument('--gzip', action='store_true', help='Also write precompressed .gz files of packages.json and shards')
+    parser.add_argument('--shards', action='store_true', help=f'Also write one file per package into {PACKAGE_SHARDS_PATH.name}/ and index them in repository.json')
+    parser.add_argument('--profile', action='store_true', help='Print wall time, bytes read and written and cache hits per stage')
+    parser.add_argument('--trace_json', '--trace-json', type=Path, help='Write a Chrome trace of all stages and themes to this file')
+    parser.add_argument('--stale', type=str, choices=STALE_POLICIES, default='warn',
+                        help='What to do if the newest published package of a theme differs from its sources')
+    parser.add_argument('--watch', action='store_true', help='Keep running and rebuild themes as soon as they are edited')
+    parser.add_argument('--debounce', type=int, default=WATCH_DEBOUNCE_MS, help='Milliseconds without changes before --watch rebuilds')
+    parser.add_argument('--poll', action='store_true', help='Poll for changes with --watch instead of using inotify')
+
+    args = parser.parse_args()
+
+    if args.profile or args.trace_json:
+        build_profile.enable()
+
+    with build_profile.span("create_repository"):
+        state = build_repository(args)
+
+    if args.trace_json:
+        build_profile.write_trace(args.trace_json)
+    if args.profile:
+        build_profile.print_profile()
+
+    if args.watch:
+        watch(args, *state)
+
+
+def build_repository(args):
+    base_uri = args.base_uri.rstrip("/")
+    with build_profile.span("load_state"):
+        manifest = {} if args.force else load_manifest()
+        package_cache = load_package_cache()
+        previous_repository = load_repository_json()
+
+    with build_profile.span("scan"):
+        theme_paths = theme_resolver.theme_dirs(ROOT_PATH)
+
+    # fail before anything is written if a theme is broken
+    with build_profile.span("validate"):
+        error_count = validate_themes.print_results(validate_themes.validate_all(theme_paths, max(1, args.jobs)), warnings=False)
+    if error_count:
+        print("* validation failed, repository is not updated")
+        exit(1)
+
+    if args.icons:
+        png = create_icon.cairosvg is not None
+        if not png:
+            print(f"* cairosvg is not installed, {ICON_FILENAME} files are not updated")
+        with build_profile.span("create_icons"):
+            create_icon.create_all_icons(theme_paths, max(1, args.jobs), png=png)
+
+    # published packages are never rebuilt, so edits without a new version would never be shipped
+    if args.stale != 'ignore':
+        with build_profile.span("find_stale_themes"):
+            stale_themes = find_stale_themes(theme_paths, max(1, args.jobs))
+        print_stale_themes(stale_themes)
+        if stale_themes and args.stale == 'fail':
+            print("* stale packages found, repository is not updated")
+            exit(1)
 
-if __name__ == "__main__":
     # create all package zip files and return the full schema of each one
-    schemas = []
-    for path in ROOT_PATH.iterdir():
-        if path.is_dir():
-            schema = create_and_get_pcm(path)
-            if schema:
-                schemas.append(schema)
-    schemas = sorted(schemas, key=lambda d: d['identifier'])
-
-    # write packages.json and repository.json
-    write_packages_json(schemas)
-    write_resources_zip()
-    write_repository_json()
+    with build_profile.span("build_all"):
+        manifest = build_all(theme_paths, manifest, package_cache, max(1, args.jobs), args.verify, base_uri)
+
+    repository = publish(manifest, package_cache, previous_repository, args, base_uri)
+    return manifest, package_cache, repository
+
+
+def publish(manifest, package_cache, previous_repository, args, base_uri):
+    # returns the index entries of packages.json and resources.zip, which are the previous ones of the next publish
+    with build_profile.span("write_state"):
+        write_manifest(manifest)
+        write_package_cache(package_cache)
+
+    schemas = sorted((entry["schema"] for entry in manifest.values()), key=lambda d: d['identifier'])
+    resource_icons = [(entry["schema"]["identifier"], ROOT_PATH / name / ICON_FILENAME) for name, entry in manifest.items()]
+
+    # write packages.json and repository.json, unchanged files keep their content and update time
+    packages_entry = write_packages_json(schemas, previous_repository, args.compact, args.gzip)
+    if args.shards:
+        with build_profile.span("write_package_shards"):
+            package_shards = write_package_shards(schemas, args.compact, args.gzip, base_uri)
+    else:
+        package_shards = None
+    with build_profile.span("write_resources_zip"):
+        resources_entry = write_resources_zip(resource_icons, previous_repository)
+    with build_profile.span("write_repository_json"):
+        write_repository_json(packages_entry, resources_entry, package_shards, base_uri)
+
+    return {"packages": packages_entry, "resources": resources_entry}
+
+
+def is_watched_source(path):
+    # files which end up in a package, generated icons and the packages themselves do not trigger a rebuild
+    return (path.suffix == ".json" and not path.name.startswith(".")) or path.name == ICON_FILENAME
+
+
+def rebuild_theme(path, manifest, package_cache, args, base_uri, png):
+    # rebuilds a single theme in place of manifest, a broken theme keeps its previous packages
+    if not path.is_dir():
+        if manifest.pop(path.name, None) is not None:
+            print(f"* removed: {path.name}")
+        return
+
+    result = validate_themes.validate_theme_dir(path)
+    identifiers = {entry["schema"]["identifier"]: name for name, entry in manifest.items() if name != path.name}
+    if result.identifier in identifiers:
+        result.errors.append(f"identifier '{result.identifier}' is used by {identifiers[result.identifier]}")
+    if validate_themes.print_results([result], warnings=False):
+        print(f"* validation failed, {path.name} is not updated")
+        return
+
+    if args.icons:
+        create_icon.create_icons(path, png=png)
+
+    entry, _ = build_theme(path, manifest.get(path.name), package_cache, False, base_uri)
+    if entry:
+        manifest[path.name] = entry
+    else:
+        manifest.pop(path.name, None)
+
+    if args.stale != 'ignore':
+        stale = stale_files_of_theme(path)
+        if stale is not None:
+            print_stale_themes({path.name: stale})
+
+
+def with_dependent_themes(theme_paths, manifest):
+    # themes based on a changed theme have to be rebuilt as well
+    changed = {path.name for path in theme_paths}
+    dependents = set(theme_paths)
+    for name in manifest:
+        theme_file = create_icon.find_theme_json(ROOT_PATH / name)
+        try:
+            base_files = theme_resolver.theme_chain(theme_file)[1:] if theme_file is not None else ()
+        except (OSError, ValueError):
+            continue
+        if any(base_file.parent.name in changed for base_file in base_files):
+            dependents.add(ROOT_PATH / name)
+    return dependents
+
+
+def watch(args, manifest, package_cache, repository):
+    # manifest, package cache and templates stay loaded, an edit only rebuilds the theme it belongs to
+    base_uri = args.base_uri.rstrip("/")
+    png = args.icons and create_icon.cairosvg is not None
+    watcher = theme_watcher.create_watcher(ROOT_PATH, args.poll)
+    print(f"* watching {ROOT_PATH} for changes, press Ctrl+C to stop")
+
+    try:
+        while True:
+            theme_paths = theme_watcher.changed_theme_dirs(watcher, ROOT_PATH, is_watched_source, args.debounce / 1000)
+            # e.g. the package shards written by the previous rebuild
+            theme_paths = {path for path in theme_paths if theme_resolver.is_theme_dir_name(path)}
+            if not theme_paths:
+                continue
+            start = time.perf_counter()
+            theme_paths = with_dependent_themes(theme_paths, manifest)
+            for path in sorted(theme_paths):
+                rebuild_theme(path, manifest, package_cache, args, base_uri, png)
+            repository = publish(manifest, package_cache, repository, args, base_uri)
+            print(f"* rebuilt {', '.join(sorted(path.name for path in theme_paths))} in {(time.perf_counter() - start) * 1000:.0f} ms")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+if __name__ == "__main__":
+    main()
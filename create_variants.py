@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import time
+
+from pathlib import Path
+
+import numpy as np
+
+import atomic_file
+import kicad_color
+import theme_resolver
+from analyze_themes import RGB_TO_XYZ, LAB_WHITE, background_index, key_vocabulary, linearize, palette_array, to_lab
+from create_icon import ROOT_PATH, find_theme_json
+from create_repository import version_key
+from theme_resolver import METADATA_FILEAME
+
+XYZ_TO_RGB = np.linalg.inv(RGB_TO_XYZ)
+
+# Machado et al. 2009, simulation of a full dichromacy in linear RGB
+CVD_SIMULATION = {
+    "deuteranopia": np.array([
+        [0.367322, 0.860646, -0.227968],
+        [0.280085, 0.672501, 0.047413],
+        [-0.011820, 0.042940, 0.968881],
+    ]),
+    "protanopia": np.array([
+        [0.152286, 1.052583, -0.204868],
+        [0.114503, 0.786281, 0.099216],
+        [-0.003882, -0.048116, 1.051998],
+    ]),
+}
+# moves the part of a color which is lost for red-green color blindness into green and blue
+CVD_ERROR_SHIFT = np.array([
+    [0.0, 0.0, 0.0],
+    [0.7, 1.0, 0.0],
+    [0.7, 0.0, 1.0],
+])
+
+TRANSFORMS = ["invert", "deuteranopia", "protanopia", "contrast"]
+TRANSFORM_LABELS = {
+    "invert": "inverted",
+    "deuteranopia": "deuteranopia",
+    "protanopia": "protanopia",
+    "contrast": "high contrast",
+}
+
+DEFAULT_CONTRAST_FACTOR = 1.5
+
+DEFAULT_VERSION = {"version": "1.0", "status": "stable", "kicad_version": "5.99"}
+
+
+def delinearize(linear):
+    return np.where(linear <= 0.0031308, linear * 12.92, 1.055 * np.power(linear, 1 / 2.4) - 0.055)
+
+
+def from_lab(lab):
+    fy = (lab[..., 0] + 16) / 116
+    f = np.stack([fy + lab[..., 1] / 500, fy, fy - lab[..., 2] / 200], axis=-1)
+    xyz = np.where(f > 6 / 29, f ** 3, 3 * (6 / 29) ** 2 * (f - 4 / 29)) * LAB_WHITE
+    return delinearize(np.clip(xyz @ XYZ_TO_RGB.T, 0, 1))
+
+
+def invert(rgb, keys, present):
+    # swaps light and dark by mirroring the lightness, hue and chroma are kept
+    lab = to_lab(rgb)
+    lab[..., 0] = 100 - lab[..., 0]
+    return from_lab(lab)
+
+
+def daltonize(rgb, simulation):
+    linear = linearize(rgb)
+    error = linear - linear @ simulation.T
+    return delinearize(np.clip(linear + error @ CVD_ERROR_SHIFT.T, 0, 1))
+
+
+def boost_contrast(rgb, keys, present, factor=DEFAULT_CONTRAST_FACTOR):
+    # scales the lightness difference of every layer to the background of its section
+    bg_index = background_index(keys)
+    has_background = (bg_index >= 0) & (bg_index != np.arange(len(keys)))
+    safe_index = np.where(has_background, bg_index, 0)
+
+    lab = to_lab(rgb)
+    background_lightness = lab[:, safe_index, 0]
+    boosted = np.clip(background_lightness + (lab[..., 0] - background_lightness) * factor, 0, 100)
+    apply = has_background & present[:, safe_index]
+    lab[..., 0] = np.where(apply, boosted, lab[..., 0])
+    return from_lab(lab)
+
+
+def apply_transforms(colors, present, keys, transforms, contrast_factor=DEFAULT_CONTRAST_FACTOR):
+    # (themes x keys x 4) uint8 colors in, transformed colors out, alpha is kept
+    rgb = colors[..., :3].astype(np.float64) / 255
+    for transform in transforms:
+        if transform == "invert":
+            rgb = invert(rgb, keys, present)
+        elif transform == "contrast":
+            rgb = boost_contrast(rgb, keys, present, contrast_factor)
+        else:
+            rgb = daltonize(rgb, CVD_SIMULATION[transform])
+
+    result = colors.copy()
+    result[..., :3] = np.rint(np.clip(rgb, 0, 1) * 255).astype(np.uint8)
+    return result
+
+
+def replace_colors(section, colors, prefix):
+    # copy of a theme section with the colors of all "<prefix><key>" replaced
+    replaced = {}
+    for key, value in section.items():
+        if isinstance(value, dict):
+            replaced[key] = replace_colors(value, colors, f"{prefix}{key}.")
+        elif f"{prefix}{key}" in colors and isinstance(value, str):
+            replaced[key] = colors[f"{prefix}{key}"]
+        else:
+            replaced[key] = value
+    return replaced
+
+
+def variant_theme(theme, colors, name, label):
+    variant = {}
+    for key, value in theme.items():
+        if key in kicad_color.PALETTE_SECTIONS:
+            variant[key] = replace_colors(value, colors, f"{key}.")
+        else:
+            variant[key] = value
+    meta = theme.get("meta", {})
+    variant["meta"] = {**meta, "filename": name, "name": f"{meta.get('name', name)} ({label})"}
+    return variant
+
+
+def variant_metadata(theme_dir, name, label):
+    # the metadata.json of the variant is derived from the one of its theme, None if the theme has none,
+    # as author, maintainer and license of the variant are not known then
+    metadata_path = theme_dir / METADATA_FILEAME
+    if not metadata_path.exists():
+        return None
+    with metadata_path.open("rb") as f:
+        metadata = json.load(f)
+    newest = max(metadata["versions"], key=lambda version: version_key(version["version"]))
+    version = {**DEFAULT_VERSION, "kicad_version": newest.get("kicad_version", DEFAULT_VERSION["kicad_version"])}
+    description_full = metadata["description_full"].rstrip().rstrip(".")
+
+    return {
+        **metadata,
+        "name": f"{metadata['name']} ({label})",
+        "description": f"{metadata['description']} ({label})",
+        "description_full": f"{description_full}. Generated {label} variant of {theme_dir.name}.",
+        "identifier": f"{metadata['identifier']}-{name.removeprefix(theme_dir.name + '-')}",
+        "versions": [version],
+    }
+
+
+def write_if_changed(path, data):
+    if path.exists() and path.read_bytes() == data:
+        return False
+    atomic_file.write_file_atomic(path, data)
+    return True
+
+
+def create_variants(theme_files, transforms, output_dir=ROOT_PATH, contrast_factor=DEFAULT_CONTRAST_FACTOR):
+    # all themes are transformed in one batch, returns the written theme files
+    themes = [theme_resolver.load_theme(theme_file) for theme_file in theme_files]
+    palettes = [kicad_color.Palette.from_theme(theme) for theme in themes]
+    keys = key_vocabulary(palettes)
+    colors, present = palette_array(palettes, keys)
+
+    transformed = apply_transforms(colors, present, keys, transforms, contrast_factor)
+    packed = (transformed.astype(np.uint32) << np.array([24, 16, 8, 0], dtype=np.uint32)).sum(axis=-1, dtype=np.uint32)
+
+    suffix = "-".join(transforms)
+    label = ", ".join(TRANSFORM_LABELS[transform] for transform in transforms)
+    written = []
+    for t, theme_file in enumerate(theme_files):
+        theme_dir = theme_file.parent
+        name = f"{theme_dir.name}-{suffix}"
+        variant_colors = {keys[k]: kicad_color.to_kicad(int(packed[t, k])) for k in np.flatnonzero(present[t])}
+
+        variant_dir = output_dir / name
+        variant_dir.mkdir(parents=True, exist_ok=True)
+        variant_file = variant_dir / f"{name}.json"
+        data = json.dumps(variant_theme(themes[t], variant_colors, name, label), indent=2).encode("utf-8")
+        if write_if_changed(variant_file, data):
+            written.append(variant_file)
+
+        # an existing metadata.json is kept, it may have got new versions since
+        metadata_path = variant_dir / METADATA_FILEAME
+        if not metadata_path.exists():
+            metadata = variant_metadata(theme_dir, name, label)
+            if metadata is None:
+                print(f"* {theme_dir.name} has no {METADATA_FILEAME}, {name} is not packaged until it gets one")
+            else:
+                atomic_file.write_file_atomic(metadata_path, json.dumps(metadata, indent=4).encode("utf-8"))
+
+    return written
+
+
+def is_variant(theme_dir):
+    return any(theme_dir.name.endswith(f"-{transform}") for transform in TRANSFORMS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create light/dark inverted, color blind safe or high contrast variants of themes (requires numpy)')
+    parser.add_argument('theme_dir', type=Path, nargs='*', help='Directory of a color scheme')
+    parser.add_argument('--all', action='store_true', help='Create variants of all themes of this repository which are no variants themselves')
+    parser.add_argument('-t', '--transform', type=str, choices=TRANSFORMS, action='append', required=True,
+                        help='Transform to apply, can be repeated to apply several transforms in order')
+    parser.add_argument('--contrast_factor', type=float, default=DEFAULT_CONTRAST_FACTOR, help='Lightness difference to the background is multiplied by this')
+    parser.add_argument('-o', '--output_dir', type=Path, default=ROOT_PATH, help='Directory the variant theme directories are created in')
+
+    args = parser.parse_args()
+
+    if args.all:
+        theme_dirs = [path for path in theme_resolver.theme_dirs(ROOT_PATH) if not is_variant(path)]
+    else:
+        theme_dirs = args.theme_dir
+    theme_files = [theme_file for theme_file in (find_theme_json(theme_dir) for theme_dir in theme_dirs) if theme_file is not None]
+    if not theme_files:
+        parser.error("either a theme_dir or --all is required")
+
+    start = time.perf_counter()
+    written = create_variants(theme_files, args.transform, args.output_dir, args.contrast_factor)
+    for variant_file in written:
+        print(f"* write {variant_file}")
+    print(f"* {len(theme_files)} themes transformed in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
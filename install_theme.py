@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+
+from pathlib import Path
+
+import atomic_file
+import theme_resolver
+from create_icon import ROOT_PATH, find_theme_json
+
+COLORS_DIRNAME = "colors"
+
+# settings files which store the active color theme in "appearance.color_theme"
+THEME_SETTINGS_FILES = {
+    "eeschema": "eeschema.json",
+    "pcbnew": "pcbnew.json",
+}
+
+COLOR_THEME_REGEX = re.compile(r'("color_theme"\s*:\s*)"(?:[^"\\]|\\.)*"')
+
+
+def kicad_config_base():
+    if "KICAD_CONFIG_HOME" in os.environ:
+        return Path(os.environ["KICAD_CONFIG_HOME"])
+    if sys.platform == "win32":
+        return Path(os.environ.get("APPDATA", Path.home() / "AppData" / "Roaming")) / "kicad"
+    if sys.platform == "darwin":
+        return Path.home() / "Library" / "Preferences" / "kicad"
+    return Path(os.environ.get("XDG_CONFIG_HOME", Path.home() / ".config")) / "kicad"
+
+
+def version_key(path):
+    return tuple(int(part) if part.isdigit() else 0 for part in path.name.split("."))
+
+
+def resolve_config_dir(config_dir=None, kicad_version=None):
+    # KiCad 6 and newer keep their settings in a subdirectory named by the major version
+    base = Path(config_dir) if config_dir else kicad_config_base()
+    if kicad_version:
+        return base / kicad_version
+
+    versions = [path for path in base.glob("*.*") if path.is_dir() and path.name.split(".")[0].isdigit()]
+    if versions:
+        return max(versions, key=version_key)
+    return base
+
+
+def sha256_of_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def install_theme(theme_file, colors_dir):
+    # returns True if the theme was written, False if the installed one is identical
+    data = theme_resolver.theme_data(theme_file)
+    target = colors_dir / theme_file.name
+
+    if target.exists() and target.stat().st_size == len(data) \
+            and sha256_of_bytes(target.read_bytes()) == sha256_of_bytes(data):
+        return False
+
+    atomic_file.write_file_atomic(target, data, keep_mode=True)
+    return True
+
+
+def set_color_theme(settings_path, theme_name):
+    # only the value of "color_theme" is replaced, the rest of the file is kept as is.
+    # Raises ValueError if the settings are no JSON object
+    if not settings_path.exists():
+        return False
+
+    text = settings_path.read_text(encoding="utf-8")
+    settings = json.loads(text)
+    if not isinstance(settings, dict) or not isinstance(settings.get("appearance", {}), dict):
+        raise ValueError("settings are no JSON object")
+    expected = dict(settings)
+    expected["appearance"] = {**settings.get("appearance", {}), "color_theme": theme_name}
+
+    # other objects may have a "color_theme" as well, an edit is only kept if it changed appearance.color_theme
+    replacement = json.dumps(theme_name)
+    for match in COLOR_THEME_REGEX.finditer(text):
+        new_text = text[:match.start()] + match.group(1) + replacement + text[match.end():]
+        if json.loads(new_text) == expected:
+            break
+    else:
+        new_text = json.dumps(expected, indent=2) + "\n"
+
+    if new_text == text:
+        return False
+
+    atomic_file.write_file_atomic(settings_path, new_text.encode("utf-8"), keep_mode=True)
+    return True
+
+
+def theme_dirs_of_repository():
+    return [path for path in theme_resolver.theme_dirs(ROOT_PATH) if find_theme_json(path) is not None]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Install KiCad 6+ JSON color themes into the KiCad config directory')
+    parser.add_argument('theme_dir', type=Path, nargs='*', help='Directory of a color scheme')
+    parser.add_argument('--all', action='store_true', help='Install all themes of this repository')
+    parser.add_argument('-c', '--config_dir', type=Path, help='KiCad config directory (default: autodetect)')
+    parser.add_argument('-k', '--kicad_version', type=str, help='KiCad version subdirectory, e.g. 6.0 (default: newest one)')
+    parser.add_argument('-a', '--activate', type=str, choices=sorted(THEME_SETTINGS_FILES), action='append',
+                        help='Make the installed theme the active one of this application, can be repeated')
+
+    args = parser.parse_args()
+
+    theme_dirs = theme_dirs_of_repository() if args.all else args.theme_dir
+    if not theme_dirs:
+        parser.error("either a theme_dir or --all is required")
+    if args.activate and len(theme_dirs) != 1:
+        parser.error("--activate requires exactly one theme")
+
+    config_dir = resolve_config_dir(args.config_dir, args.kicad_version)
+    colors_dir = config_dir / COLORS_DIRNAME
+    colors_dir.mkdir(parents=True, exist_ok=True)
+    print(f"installing into {colors_dir}")
+
+    theme_file = None
+    for theme_dir in theme_dirs:
+        theme_file = find_theme_json(theme_dir) if theme_dir.is_dir() else None
+        if theme_file is None:
+            print(f"no .json found in {theme_dir}")
+            continue
+
+        try:
+            installed = install_theme(theme_file, colors_dir)
+        except ValueError as e:
+            print(f"cannot install {theme_file}, {e}")
+            continue
+        if installed:
+            print(f"* installed {theme_file.name}")
+        else:
+            print(f"* unchanged {theme_file.name}")
+
+    failed = False
+    for application in args.activate or []:
+        if theme_file is None:
+            break
+        settings_path = config_dir / THEME_SETTINGS_FILES[application]
+        try:
+            activated = set_color_theme(settings_path, theme_file.stem)
+        except (OSError, ValueError) as e:
+            print(f"cannot activate {theme_file.stem} in {settings_path}, {e}")
+            failed = True
+            continue
+        if activated:
+            print(f"* {theme_file.stem} is now the color theme of {application}")
+        elif not settings_path.exists():
+            print(f"* {settings_path} does not exist, start {application} once before activating a theme")
+
+    if failed:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import functools
+
+from array import array
+
+# colors are packed into a single int 0xRRGGBBAA, with the KiCad alpha (0.0 - 1.0) scaled to 0 - 255
+
+PALETTE_SECTIONS = ['board', 'schematic', 'fpedit']
+
+
+def pack(red, green, blue, alpha=255):
+    return (red << 24) | (green << 16) | (blue << 8) | alpha
+
+
+def unpack(color):
+    return (color >> 24) & 0xFF, (color >> 16) & 0xFF, (color >> 8) & 0xFF, color & 0xFF
+
+
+def parse_color(kicad_color):
+    # parses "rgb(r, g, b)" and "rgba(r, g, b, a)" without regex, raises ValueError for anything else
+    if not isinstance(kicad_color, str):
+        raise ValueError(f"cannot parse color {kicad_color!r}, it is no string")
+    return parse_color_text(kicad_color)
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_color_text(kicad_color):
+    red, green, blue, alpha = color_components(kicad_color)
+    return pack(red, green, blue, round(alpha * 255))
+
+
+def color_components(kicad_color):
+    # red, green and blue as int, alpha as float at the precision of the text, 1.0 for "rgb(...)"
+    if not isinstance(kicad_color, str):
+        raise ValueError(f"cannot parse color {kicad_color!r}, it is no string")
+    return color_components_text(kicad_color)
+
+
+@functools.lru_cache(maxsize=4096)
+def color_components_text(kicad_color):
+    text = kicad_color.strip()
+    if text.startswith("rgba"):
+        components = 4
+        text = text[4:]
+    elif text.startswith("rgb"):
+        components = 3
+        text = text[3:]
+    else:
+        raise ValueError(f"cannot parse color {kicad_color}")
+
+    text = text.strip()
+    if not text.startswith("(") or not text.endswith(")"):
+        raise ValueError(f"cannot parse color {kicad_color}")
+
+    parts = text[1:-1].split(",")
+    if len(parts) != components:
+        raise ValueError(f"cannot parse color {kicad_color}")
+
+    try:
+        red, green, blue = (int(part) for part in parts[:3])
+        alpha = float(parts[3]) if components == 4 else 1.0
+    except ValueError:
+        raise ValueError(f"cannot parse color {kicad_color}") from None
+
+    # an infinite or nan alpha fails this check as well
+    if not all(0 <= value <= 255 for value in (red, green, blue)) or not 0.0 <= alpha <= 1.0:
+        raise ValueError(f"color out of range {kicad_color}")
+
+    return red, green, blue, alpha
+
+
+def parse_many(kicad_colors):
+    return array('L', map(parse_color, kicad_colors))
+
+
+def is_color(kicad_color):
+    try:
+        parse_color(kicad_color)
+        return True
+    except (ValueError, AttributeError):
+        return False
+
+
+def colors_equal(a, b):
+    # compares the colors, not the strings, falls back to a string compare if one is no color. Alpha is compared
+    # at full precision, packed colors would consider alpha values within 1/255 of each other equal
+    try:
+        return color_components(a) == color_components(b)
+    except ValueError:
+        return a == b
+
+
+def to_hex(color):
+    red, green, blue, _ = unpack(color)
+    return f"#{red:02X}{green:02X}{blue:02X}"
+
+
+def to_kicad(color):
+    red, green, blue, alpha = unpack(color)
+    if alpha == 255:
+        return f"rgb({red}, {green}, {blue})"
+    # 8 bit alpha has less precision than the 3 decimals KiCad writes, so round to 2 decimals
+    return f"rgba({red}, {green}, {blue}, {round(alpha / 255, 2):.3f})"
+
+
+def flatten_section(section, prefix=""):
+    # nested theme sections like "copper": {"f": ...} become "copper.f"
+    for key, value in section.items():
+        if isinstance(value, dict):
+            yield from flatten_section(value, f"{prefix}{key}.")
+        else:
+            yield f"{prefix}{key}", value
+
+
+class Palette:
+    # all colors of one theme, the keys are "<section>.<key>" and the colors are stored in one array
+
+    __slots__ = ('keys', 'colors', '_index')
+
+    def __init__(self, keys, colors):
+        self.keys = tuple(keys)
+        self.colors = colors
+        self._index = None
+
+    @classmethod
+    def from_theme(cls, theme_json, sections=PALETTE_SECTIONS):
+        keys = []
+        values = []
+        for section in sections:
+            for key, value in flatten_section(theme_json.get(section, {}), f"{section}."):
+                if isinstance(value, str):
+                    keys.append(key)
+                    values.append(value)
+        return cls(keys, parse_many(values))
+
+    def index(self):
+        if self._index is None:
+            self._index = {key: i for i, key in enumerate(self.keys)}
+        return self._index
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.index()
+
+    def __getitem__(self, key):
+        return self.colors[self.index()[key]]
+
+    def get(self, key, default=None):
+        i = self.index().get(key)
+        return default if i is None else self.colors[i]
+
+    def items(self):
+        return zip(self.keys, self.colors)
+
+    def __eq__(self, other):
+        return isinstance(other, Palette) and self.keys == other.keys and self.colors == other.colors
+
+    def diff(self, other):
+        # keys whose color differs, or which exist in only one of both palettes
+        changed = [key for key, color in self.items() if other.get(key) != color]
+        changed.extend(key for key in other.keys if key not in self.index())
+        return changed
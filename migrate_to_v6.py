@@ -1,9 +1,16 @@
 #!/usr/bin/env python3
 import argparse
+import hashlib
 import json
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import re
 
+import theme_resolver
+from kicad_color import is_color
+
+ROOT_PATH = Path(__file__).resolve().parent
+
 
 KEY_MAP = {
     "Color4DBgCanvasEx":            "schematic.background",
@@ -173,48 +180,50 @@ KEY_MAP = {
 }
 
 
-def recursive_insert(dictionary, keys, value):
-    if len(keys) > 1:
-        key = keys.pop(0)
-        if key in dictionary:
-            nested = dictionary[key]
-        else:
-            nested = dict()
-        dictionary[key] = recursive_insert(nested, keys, value)
-        return dictionary
-    else:
-        dictionary[keys[0]] = value
-        return dictionary
+# KEY_MAP with the json keys already split into their path, for pcbnew/eeschema and the footprint editor
+KEY_INDEX = {key: tuple(json_key.split('.')) for key, json_key in KEY_MAP.items()}
+FPEDIT_KEY_INDEX = {key: ('fpedit',) + keys[1:] for key, keys in KEY_INDEX.items()}
 
+SCHEME_FILES = ['eeschema', 'pcbnew', 'footprint_editor']
 
-def main():
-    parser = argparse.ArgumentParser(description='Migrate a scheme to V6 JSON format')
-    parser.add_argument('scheme_path', type=Path, nargs=1, help='Path to scheme definition')
-    parser.add_argument('name', type=str, nargs=1, help='Display name of the output theme')
+# themes written by this script have version 0, newer versions are maintained by hand and never overwritten
+MIGRATED_VERSION = 0
+
+# sha256 of the legacy files a theme was migrated from, stored in its meta section
+SOURCE_HASH_KEY = "source_sha256"
 
-    args = parser.parse_args()
 
-    if not args.scheme_path[0].is_dir():
-        print("'{}' needs to be the directory of a scheme".format(args.scheme_path[0]))
+def recursive_insert(dictionary, keys, value):
+    nested = dictionary
+    for key in keys[:-1]:
+        nested = nested.setdefault(key, {})
+    nested[keys[-1]] = value
+    return dictionary
 
-    filename = args.scheme_path[0].stem
+
+def migrate_scheme(scheme_path, name, filename=None, verbose=True):
+    if filename is None:
+        filename = scheme_path.stem
 
     json_data = {
         "meta": {
             "filename": filename,
-            "version": 0,
-            "name": args.name[0]
+            "version": MIGRATED_VERSION,
+            "name": name,
+            SOURCE_HASH_KEY: source_hash(scheme_path)
         }
     }
 
-    for file in ['eeschema', 'pcbnew', 'footprint_editor']:
-        fp  = args.scheme_path[0] / file
+    for file in SCHEME_FILES:
+        fp  = scheme_path / file
 
         if not fp.is_file():
             continue
 
-        print("Migrating {}".format(fp.name))
+        if verbose:
+            print("Migrating {}".format(fp.name))
 
+        key_index = FPEDIT_KEY_INDEX if file == 'footprint_editor' else KEY_INDEX
         data = {}
 
         with open(fp, 'r') as f:
@@ -229,27 +238,109 @@ def main():
                 except:
                     continue
 
-                if color is not None:
-                    try:
-                        json_key = KEY_MAP[key]
-                    except:
-                        print("Warning: unknown key {}".format(key))
-                        continue
-
-                    keys = json_key.split('.')
+                keys = key_index.get(key)
+                if keys is None:
+                    print("Warning: unknown key {}".format(key))
+                    continue
 
-                    if file == 'footprint_editor':
-                        keys[0] = 'fpedit'
+                if not is_color(color):
+                    print("Warning: invalid color {} of key {}".format(color, key))
+                    continue
 
-                    recursive_insert(data, keys, color)
+                recursive_insert(data, keys, color)
 
         json_data.update(data)
 
+    return json_data
+
 
-    new_file_path = args.scheme_path[0] / (filename + ".json")
+def write_theme(json_data, new_file_path):
     with open(new_file_path, 'w') as f:
         json.dump(json_data, f, sort_keys=True, indent=2)
 
 
+def legacy_sources(scheme_path):
+    return [scheme_path / file for file in SCHEME_FILES if (scheme_path / file).is_file()]
+
+
+def source_hash(scheme_path):
+    # content hash of the legacy files, file times are no help as a checkout sets them all to the same moment
+    source_sha256 = hashlib.sha256()
+    for source in legacy_sources(scheme_path):
+        data = source.read_bytes()
+        source_sha256.update(f"{source.name}\0{len(data)}\0".encode())
+        source_sha256.update(data)
+    return source_sha256.hexdigest()
+
+
+def display_name(scheme_path):
+    return scheme_path.name.replace('-', ' ').replace('_', ' ').title()
+
+
+def migrate_if_outdated(scheme_path, force=False, create=False):
+    # returns the written theme file, or None if the theme is up to date or maintained by hand
+    new_file_path = scheme_path / (scheme_path.name + ".json")
+    name = display_name(scheme_path)
+
+    if new_file_path.exists():
+        try:
+            with open(new_file_path, 'r') as f:
+                meta = json.load(f).get("meta", {})
+        except ValueError:
+            meta = {}
+        if meta.get("version", MIGRATED_VERSION) != MIGRATED_VERSION:
+            return None
+        name = meta.get("name", name)
+
+        # a theme without a source hash was not written by this script, or before it stored one
+        if not force and meta.get(SOURCE_HASH_KEY) in (None, source_hash(scheme_path)):
+            return None
+    elif not create:
+        return None
+
+    write_theme(migrate_scheme(scheme_path, name, scheme_path.name, verbose=False), new_file_path)
+    return new_file_path
+
+
+def migrate_all(root_path, jobs=None, force=False, create=False):
+    scheme_paths = [path for path in theme_resolver.theme_dirs(root_path) if legacy_sources(path)]
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(migrate_if_outdated, scheme_paths, [force] * len(scheme_paths),
+                                    [create] * len(scheme_paths)))
+
+    for scheme_path, result in zip(scheme_paths, results):
+        if result is not None:
+            print("Migrated {}".format(result))
+    return [result for result in results if result is not None]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate a scheme to V6 JSON format')
+    parser.add_argument('scheme_path', type=Path, nargs='?', help='Path to scheme definition')
+    parser.add_argument('name', type=str, nargs='?', help='Display name of the output theme')
+    parser.add_argument('--all', action='store_true', help='Migrate all legacy schemes of this repository whose JSON theme is outdated')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of processes used by --all')
+    parser.add_argument('--force', action='store_true', help='Migrate with --all even if the JSON theme is up to date')
+    parser.add_argument('--create', action='store_true', help='Also create a JSON theme with --all in legacy schemes which have none')
+
+    args = parser.parse_args()
+
+    if args.all:
+        migrate_all(ROOT_PATH, args.jobs, args.force, args.create)
+        return
+
+    if args.scheme_path is None or args.name is None:
+        parser.error("scheme_path and name are required without --all")
+
+    if not args.scheme_path.is_dir():
+        print("'{}' needs to be the directory of a scheme".format(args.scheme_path))
+
+    json_data = migrate_scheme(args.scheme_path, args.name)
+
+    new_file_path = args.scheme_path / (json_data["meta"]["filename"] + ".json")
+    write_theme(json_data, new_file_path)
+
+
 if __name__ == '__main__':
     main()
@@ -1,122 +1,313 @@
 #!/usr/bin/env python3
 import sys, os
 import argparse
+import glob
+import json
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import shutil
+import tempfile
+
+from kicad_color import colors_equal
+
+
+def split_config_line(line):
+    # returns (key, value) of a 'key=value' line, None for empty lines, comments and section headers
+    l = line.strip()
+    if l == b'' or line.startswith(b'[') or line.startswith(b'#'):
+        return None
+    key, value = l.split(b'=', 1)
+    return key, value
+
+
+def load_patch(patchfile):
+    # parses a scheme patch file once, so it can be applied to any number of config files
+    changes = OrderedDict()
+    with open(patchfile, 'r') as file:
+        idx = 0
+        for line in file:
+            l = line.strip()
+            if l == '' or (line.startswith('[') or line.startswith('#')):
+                continue
+
+            try:
+                key, value = l.split('=')
+            except:
+                raise ValueError("line {}: '{}' is of invalid format in patch file.".format(idx, l))
+
+            changes[key] = value
+            idx += 1
+    return changes
+
 
 class ConfigFile():
     def __init__(self, filepath):
-        self.content = OrderedDict()
+        # the original content is kept as one buffer, untouched lines are written back as slices of it
         self.filepath = filepath
-        with open(filepath, 'r') as file:
-            idx = 0
-            for line in file:
-                l = line.strip()
-                #print(line.startswith('#'), line)
-                if l != '' and not (line.startswith('[') or line.startswith('#')):
-                    try:
-                        key, value = l.split('=', 1)
-                    except:
-                        raise ValueError("line {}: '{}' is of invalid format in config file.".format(idx, l))
-                    self.content.update({key: value})
-                    idx += 1
-
-    def patch(self, patchfile):
-        with open(patchfile, 'r') as file:
-            idx = 0
-            for line in file:
-                l = line.strip()
-                if l == '' or (line.startswith('[') or line.startswith('#')):
-                    continue
+        with open(filepath, 'rb') as file:
+            self.data = file.read()
 
-                try:
-                    key, value = l.split('=')
-                except:
-                    raise ValueError("line {}: '{}' is of invalid format in patch file.".format(idx, l))
+        self.key_spans = OrderedDict()
+        self.changes = OrderedDict()
 
-                self.content[key] = value
+        view = memoryview(self.data)
+        start = 0
+        idx = 0
+        while start < len(self.data):
+            end = self.data.find(b'\n', start)
+            end = len(self.data) if end == -1 else end + 1
+            try:
+                parsed = split_config_line(view[start:end].tobytes())
+            except ValueError:
+                raise ValueError("line {}: '{}' is of invalid format in config file.".format(idx, self.data[start:end].decode(errors='replace').strip()))
+            if parsed is not None:
+                self.key_spans.setdefault(parsed[0].decode(), []).append((start, end))
                 idx += 1
+            start = end
 
-    def write(self):
-        with open(self.filepath, 'w') as file:
-            for key, value in self.content.items():
-                print("{}={}".format(key, value), file=file)
+    @property
+    def content(self):
+        content = OrderedDict()
+        for key, spans in self.key_spans.items():
+            start, end = spans[-1]
+            content[key] = split_config_line(self.data[start:end])[1].decode()
+        content.update(self.changes)
+        return content
 
-parser = argparse.ArgumentParser(description='Patch the KiCad settings file with the given colour scheme.')
-parser.add_argument('scheme_path', type=Path, nargs=1,
-                        help='Path to scheme definition.')
-parser.add_argument('config_dir', type=Path, nargs=1,
-                        help='Path to kicad config directory')
-parser.add_argument('-p', '--pcb_disable', action='store_true', help='Disable patching of pcb_new colour definition')
-parser.add_argument('-f', '--footprint_disable', action='store_true', help='Disable patching of footprint editor colour definition')
-parser.add_argument('-e', '--eeschema_disable', action='store_true', help='Disable patching of eeschema and symbol editor colour definition')
+    def patch(self, patchfile):
+        self.apply(load_patch(patchfile))
 
-args = parser.parse_args()
+    def apply(self, changes):
+        self.changes.update(changes)
 
+    def changed_keys(self):
+        # keys whose color differs from the current content of the file
+        changed = []
+        for key, value in self.changes.items():
+            spans = self.key_spans.get(key)
+            if spans is None or not all(colors_equal(split_config_line(self.data[start:end])[1].decode(), value) for start, end in spans):
+                changed.append(key)
+        return changed
 
-if args.pcb_disable and args.footprint_disable and args.eeschema_disable:
-    print("All definitions disabled. Nothing to do. (Use --help for instructions.)")
-    exit()
+    def render(self):
+        view = memoryview(self.data)
+        replacements = []
+        for key, value in self.changes.items():
+            for start, end in self.key_spans.get(key, []):
+                line = self.data[start:end]
+                newline = line[len(line.rstrip(b'\r\n')):]
+                replacements.append((start, end, "{}={}".format(key, value).encode() + newline))
+        replacements.sort()
 
-if not args.config_dir[0].is_dir():
-    print("'{}' expected to be the kicad config directory but it is not a directory or does not exist. (Use --help for instructions.)".format(args.config_dir[0]))
-    exit()
+        chunks = []
+        position = 0
+        for start, end, line in replacements:
+            chunks.append(view[position:start])
+            chunks.append(line)
+            position = end
+        chunks.append(view[position:])
 
-if not args.scheme_path[0].is_dir():
-    print("'{}' expected to be the colour scheme definition directory but it is not a directory or does not exist. (Use --help for instructions.)".format(args.scheme_path[0]))
+        added = ["{}={}\n".format(key, value).encode() for key, value in self.changes.items() if key not in self.key_spans]
+        if added and self.data and not self.data.endswith(b'\n'):
+            chunks.append(b'\n')
+        chunks.extend(added)
+        return chunks
 
-if not args.eeschema_disable:
-    ee_patch = args.scheme_path[0] / 'eeschema'
-    if not ee_patch.is_file():
-        print("Scheme does not contain a definition for EESchema, skipped.")
-    else:
-        print("Updating EESchema configuration.")
-        ee_config = args.config_dir[0] / 'eeschema'
+    def write(self):
+        # written into a temporary file which replaces the config in one step. A symlinked config
+        # (e.g. managed dotfiles) stays a symlink, the file it points to is replaced
+        target = os.path.realpath(self.filepath)
+        directory = os.path.dirname(target)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.{}.'.format(os.path.basename(target)), suffix='.tmp')
         try:
-            shutil.copy(ee_config, str(ee_config)+".bak")
-        except:
-            answer = input("Unable to create backup file. Continue anyways? [y/n] ")
-            while(answer not in ['y', 'n']):
-                answer = input("Unable to create backup file. Continue anyways? [y/n] ")
-            if answer == 'n':
-                exit()
-
-
-        eeschema_handler = ConfigFile(ee_config)
-        eeschema_handler.patch(ee_patch)
-        eeschema_handler.write()
-
-if args.pcb_disable and args.footprint_disable:
-    print("Done")
-    exit()
-
-pcb_config = args.config_dir[0] / 'pcbnew'
-try:
-    shutil.copy(pcb_config, str(pcb_config)+".bak")
-except:
+            with os.fdopen(fd, 'wb') as file:
+                file.writelines(self.render())
+            try:
+                shutil.copymode(target, tmp_path)
+            except OSError:
+                pass
+            os.replace(tmp_path, target)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def backup_file(filepath):
+    # as write() replaces the config with a new file, a hardlink keeps the old content for free
+    # of a symlinked config the content is backed up, not the link
+    backup_path = str(filepath) + ".bak"
+    target = os.path.realpath(filepath)
+    if os.path.lexists(backup_path):
+        os.unlink(backup_path)
+    try:
+        os.link(target, backup_path)
+    except OSError:
+        shutil.copy(target, backup_path)
+
+
+BACKUP_POLICIES = ['prompt', 'skip', 'continue']
+
+
+def confirm_backup_failure():
     answer = input("Unable to create backup file. Continue anyways? [y/n] ")
     while(answer not in ['y', 'n']):
         answer = input("Unable to create backup file. Continue anyways? [y/n] ")
     if answer == 'n':
         exit()
 
-pcb_handler = ConfigFile(pcb_config)
 
-if not args.pcb_disable:
-    pcb_patch = args.scheme_path[0] / 'pcbnew'
-    if not pcb_patch.is_file():
-        print("Scheme does not contain a definition for pcb_new, skipped.")
-    else:
-        print("Updating pcb_new configuration.")
-        pcb_handler.patch(pcb_patch)
+def compile_scheme(scheme_path, eeschema=True, pcb=True, footprint=True, verbose=True):
+    # returns the changes of each config file, pcbnew and footprint editor patches are merged into one
+    def load(filename, message, skipped):
+        patchfile = scheme_path / filename
+        if not patchfile.is_file():
+            if verbose:
+                print(skipped)
+            return None
+        if verbose:
+            print(message)
+        return load_patch(patchfile)
+
+    compiled = OrderedDict()
+    if eeschema:
+        ee_patch = load('eeschema', "Updating EESchema configuration.", "Scheme does not contain a definition for EESchema, skipped.")
+        if ee_patch is not None:
+            compiled['eeschema'] = ee_patch
+
+    pcb_changes = OrderedDict()
+    if pcb:
+        pcb_patch = load('pcbnew', "Updating pcb_new configuration.", "Scheme does not contain a definition for pcb_new, skipped.")
+        if pcb_patch is not None:
+            pcb_changes.update(pcb_patch)
+    if footprint:
+        fpe_patch = load('footprint_editor', "Updating footprint editor configuration.", "Scheme does not contain a definition for the footprint editor, skipped.")
+        if fpe_patch is not None:
+            pcb_changes.update(fpe_patch)
+    if pcb or footprint:
+        compiled['pcbnew'] = pcb_changes
 
-if not args.footprint_disable:
-    fpe_patch = args.scheme_path[0] / 'footprint_editor'
-    if not fpe_patch.is_file():
-        print("Scheme does not contain a definition for the footprint editor, skipped.")
+    return compiled
+
+
+def patch_config_dir(config_dir, compiled, backup_policy='skip'):
+    # applies a compiled scheme to one kicad config directory and returns a summary of it
+    summary = OrderedDict([('config_dir', str(config_dir)), ('files', OrderedDict())])
+    if not config_dir.is_dir():
+        summary['error'] = 'not a directory'
+        return summary
+
+    for filename, changes in compiled.items():
+        config_path = config_dir / filename
+        result = OrderedDict([('changed', []), ('backup', False)])
+        summary['files'][filename] = result
+        try:
+            handler = ConfigFile(config_path)
+            handler.apply(changes)
+            result['changed'] = handler.changed_keys()
+            if not result['changed']:
+                continue
+
+            try:
+                backup_file(config_path)
+                result['backup'] = True
+            except Exception:
+                if backup_policy == 'prompt':
+                    confirm_backup_failure()
+                elif backup_policy == 'skip':
+                    result['changed'] = []
+                    result['error'] = 'unable to create backup file, skipped'
+                    continue
+
+            handler.write()
+        except (OSError, ValueError) as e:
+            result['changed'] = []
+            result['error'] = str(e)
+
+    return summary
+
+
+def expand_config_dirs(patterns, config_list=None):
+    config_dirs = []
+    if config_list is not None:
+        with open(config_list, 'r') as file:
+            patterns = list(patterns) + [line.strip() for line in file if line.strip() and not line.startswith('#')]
+
+    for pattern in patterns:
+        pattern = str(pattern)
+        if glob.has_magic(pattern):
+            config_dirs.extend(Path(path) for path in sorted(glob.glob(os.path.expanduser(pattern))))
+        else:
+            config_dirs.append(Path(os.path.expanduser(pattern)))
+    return config_dirs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Patch the KiCad settings file with the given colour scheme.')
+    parser.add_argument('scheme_path', type=Path, nargs=1,
+                            help='Path to scheme definition.')
+    parser.add_argument('config_dir', type=str, nargs='*',
+                            help='Path to kicad config directory, several directories or glob patterns patch all of them')
+    parser.add_argument('-p', '--pcb_disable', action='store_true', help='Disable patching of pcb_new colour definition')
+    parser.add_argument('-f', '--footprint_disable', action='store_true', help='Disable patching of footprint editor colour definition')
+    parser.add_argument('-e', '--eeschema_disable', action='store_true', help='Disable patching of eeschema and symbol editor colour definition')
+    parser.add_argument('-l', '--config_list', type=Path, help='File with one kicad config directory (or glob pattern) per line')
+    parser.add_argument('-j', '--jobs', type=int, default=8, help='Number of config directories patched concurrently')
+    parser.add_argument('-b', '--backup_failure', choices=BACKUP_POLICIES,
+                        help='What to do if no backup can be created (default: prompt for a single directory on a terminal, skip otherwise)')
+    parser.add_argument('-s', '--summary', type=str, help="Write a JSON summary of changed keys per directory to this file ('-' for stdout)")
+
+    args = parser.parse_args()
+
+
+    if args.pcb_disable and args.footprint_disable and args.eeschema_disable:
+        print("All definitions disabled. Nothing to do. (Use --help for instructions.)")
+        exit()
+
+    config_dirs = expand_config_dirs(args.config_dir, args.config_list)
+    if not config_dirs:
+        parser.error("at least one config_dir is required")
+
+    if not args.scheme_path[0].is_dir():
+        print("'{}' expected to be the colour scheme definition directory but it is not a directory or does not exist. (Use --help for instructions.)".format(args.scheme_path[0]))
+        exit(1)
+
+    # a glob may match a single directory, it is still meant for unattended use like a config list
+    batch = len(config_dirs) > 1 or args.config_list is not None or any(glob.has_magic(pattern) for pattern in args.config_dir)
+    # there is nobody to answer a prompt e.g. in a login script
+    interactive = sys.stdin is not None and sys.stdin.isatty()
+    backup_policy = args.backup_failure or ('prompt' if interactive and not batch else 'skip')
+    if batch and backup_policy == 'prompt':
+        parser.error("--backup_failure prompt is only possible for a single config directory")
+
+    # keep stdout clean when the summary is written to it
+    verbose = not batch and args.summary != '-'
+    compiled = compile_scheme(args.scheme_path[0], not args.eeschema_disable, not args.pcb_disable,
+                              not args.footprint_disable, verbose=verbose)
+
+    if not batch:
+        if not config_dirs[0].is_dir():
+            print("'{}' expected to be the kicad config directory but it is not a directory or does not exist. (Use --help for instructions.)".format(config_dirs[0]))
+            exit()
+        summaries = [patch_config_dir(config_dirs[0], compiled, backup_policy)]
+        for filename, result in summaries[0]['files'].items():
+            if 'error' in result:
+                print("{}: {}".format(filename, result['error']), file=sys.stderr)
+        if verbose:
+            print("Done")
     else:
-        print("Updating footprint editor configuration.")
-        pcb_handler.patch(fpe_patch)
+        with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+            summaries = list(executor.map(lambda config_dir: patch_config_dir(config_dir, compiled, backup_policy), config_dirs))
+        failed = sum(1 for summary in summaries if 'error' in summary or any('error' in result for result in summary['files'].values()))
+        print("Patched {} config directories, {} with errors.".format(len(summaries) - failed, failed), file=sys.stderr)
+
+    if args.summary == '-':
+        json.dump(summaries, sys.stdout, indent=2)
+        print()
+    elif args.summary:
+        with open(args.summary, 'w') as file:
+            json.dump(summaries, file, indent=2)
+
 
-pcb_handler.write()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+import struct
+import zlib
+
+# minimal PNG encoder for 8 bit RGB images, enough for generated previews and icons without any imaging library
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+COLOR_TYPE_RGB = 2
+
+
+def png_chunk(chunk_type, data):
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+
+def encode_png(width, height, rgb_data, level=zlib.Z_DEFAULT_COMPRESSION):
+    # rgb_data holds the rows top to bottom, 3 bytes per pixel. Every row gets filter type 0 (none), which
+    # compresses the flat areas of generated images well and keeps encoding fast
+    stride = width * 3
+    if len(rgb_data) != stride * height:
+        raise ValueError(f"expected {stride * height} bytes of pixel data, got {len(rgb_data)}")
+    scanlines = b"".join(b"\0" + rgb_data[offset:offset + stride] for offset in range(0, stride * height, stride))
+    return b"".join([
+        PNG_SIGNATURE,
+        png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, COLOR_TYPE_RGB, 0, 0, 0)),
+        png_chunk(b"IDAT", zlib.compress(scanlines, level)),
+        png_chunk(b"IEND", b""),
+    ])
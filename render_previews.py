@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+
+import argparse
+import functools
+import hashlib
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+import atomic_file
+import kicad_color
+import png_writer
+import theme_resolver
+from create_icon import ROOT_PATH, find_theme_json, is_up_to_date
+
+PREVIEW_CACHE_PATH = ROOT_PATH / ".preview_cache"
+PREVIEW_FILENAME = "preview.png"
+# part of the palette hash, increase it whenever the layout or the drawing changes
+RENDERER_VERSION = 1
+
+SHEET_BACKGROUND = kicad_color.pack(250, 250, 250)
+SHEET_TEXT = kicad_color.pack(40, 40, 40)
+
+MARGIN = 8
+COLUMNS = 5
+CELL_WIDTH = 200
+CELL_HEIGHT = 16
+SWATCH_SIZE = 12
+SHEET_WIDTH = 2 * MARGIN + COLUMNS * CELL_WIDTH
+MOCKUP_GAP = 16
+MOCKUP_WIDTH = (SHEET_WIDTH - 2 * MARGIN - (len(kicad_color.PALETTE_SECTIONS) - 1) * MOCKUP_GAP) // len(kicad_color.PALETTE_SECTIONS)
+MOCKUP_HEIGHT = 200
+
+# 5x7 bitmap font, every glyph is 7 rows of 5 bits written as 2 hex digits, the highest bit is the leftmost pixel
+GLYPH_WIDTH = 5
+GLYPH_HEIGHT = 7
+FONT = {
+    "A": "0E11111F111111", "B": "1E11111E11111E", "C": "0E11101010110E", "D": "1E11111111111E",
+    "E": "1F10101E10101F", "F": "1F10101E101010", "G": "0E11101711110F", "H": "1111111F111111",
+    "I": "0E04040404040E", "J": "0702020202120C", "K": "11121418141211", "L": "1010101010101F",
+    "M": "111B1515111111", "N": "11111915131111", "O": "0E11111111110E", "P": "1E11111E101010",
+    "Q": "0E11111115120D", "R": "1E11111E141211", "S": "0F10100E01011E", "T": "1F040404040404",
+    "U": "1111111111110E", "V": "11111111110A04", "W": "1111111515150A", "X": "11110A040A1111",
+    "Y": "11110A04040404", "Z": "1F01020408101F",
+    "0": "0E11131519110E", "1": "040C040404040E", "2": "0E11010204081F", "3": "1F02040201110E",
+    "4": "02060A121F0202", "5": "1F101E0101110E", "6": "0608101E11110E", "7": "1F010204080808",
+    "8": "0E11110E11110E", "9": "0E11110F01020C",
+    ".": "00000000000C0C", "_": "0000000000001F", "-": "0000001F000000", ",": "00000000000C04",
+    "(": "02040808080402", ")": "08040202020408", "?": "0E110102040004", " ": "00000000000000",
+}
+
+# simplified editor views, drawn in order. Shapes are ("rect", key, (x0, y0, x1, y1)), ("frame", key, box, width),
+# ("circle", key, (x, y, radius)), ("text", key, (x, y), text) and ("dots", key, spacing). The key is a section
+# key like "copper.f" or a tuple of alternatives, shapes whose color the theme does not define are skipped
+BOARD_MOCKUP = [
+    ("dots", "grid", 10),
+    ("frame", "worksheet", (4, 4, MOCKUP_WIDTH - 4, MOCKUP_HEIGHT - 4), 1),
+    ("text", "b_silks", (200, 164), "REV A"),
+    ("rect", "copper.b", (30, 60, 290, 66)),
+    ("rect", "copper.b", (30, 130, 130, 136)),
+    ("rect", "copper.in1", (30, 95, 290, 99)),
+    ("rect", "copper.f", (60, 30, 66, 170)),
+    ("rect", "copper.f", (250, 30, 256, 150)),
+    ("rect", "copper.f", (66, 40, 250, 46)),
+    ("rect", "f_mask", (146, 106, 240, 180)),
+    ("circle", ("pad_through_hole", "copper.f"), (90, 150, 10)),
+    ("circle", ("pad_plated_hole", "plated_hole"), (90, 150, 4)),
+    ("rect", ("pad_front", "copper.f"), (158, 118, 172, 132)),
+    ("rect", ("pad_front", "copper.f"), (214, 118, 228, 132)),
+    ("rect", ("pad_front", "copper.f"), (158, 154, 172, 168)),
+    ("rect", ("pad_front", "copper.f"), (214, 154, 228, 168)),
+    ("rect", "ratsnest", (100, 150, 158, 151)),
+    ("circle", "via_through", (63, 63, 7)),
+    ("circle", "via_hole", (63, 63, 3)),
+    ("circle", "via_through", (253, 133, 7)),
+    ("circle", "via_hole", (253, 133, 3)),
+    ("frame", "f_fab", (152, 112, 234, 174), 1),
+    ("text", "footprint_text_front", (180, 140), "IC"),
+    ("frame", "f_crtyd", (142, 102, 244, 182), 1),
+    ("frame", "f_silks", (148, 108, 238, 178), 2),
+    ("text", "f_silks", (148, 96), "U1"),
+    ("frame", "edge_cuts", (16, 16, MOCKUP_WIDTH - 16, MOCKUP_HEIGHT - 16), 2),
+    ("rect", "cursor", (272, 29, 289, 30)),
+    ("rect", "cursor", (280, 21, 281, 38)),
+]
+
+SCHEMATIC_MOCKUP = [
+    ("dots", "grid", 10),
+    ("frame", "worksheet", (4, 4, MOCKUP_WIDTH - 4, MOCKUP_HEIGHT - 4), 1),
+    ("text", "note", (30, 20), "NOTE"),
+    ("rect", "component_body", (120, 50, 200, 150)),
+    ("frame", "component_outline", (120, 50, 200, 150), 2),
+    ("rect", "pin", (100, 70, 120, 72)),
+    ("rect", "pin", (100, 130, 120, 132)),
+    ("rect", "pin", (200, 100, 220, 102)),
+    ("text", "pin_name", (124, 68), "IN"),
+    ("text", "pin_name", (124, 128), "EN"),
+    ("text", "pin_name", (178, 98), "OUT"),
+    ("text", "pin_number", (104, 61), "1"),
+    ("text", "pin_number", (104, 121), "2"),
+    ("text", "pin_number", (210, 91), "3"),
+    ("text", "reference", (120, 38), "U1"),
+    ("text", "value", (120, 156), "REG"),
+    ("rect", "wire", (36, 70, 100, 72)),
+    ("rect", "wire", (70, 70, 72, 132)),
+    ("rect", "wire", (70, 130, 100, 132)),
+    ("rect", "wire", (220, 100, 290, 102)),
+    ("circle", "junction", (71, 71, 4)),
+    ("text", "label_local", (36, 60), "VIN"),
+    ("text", "label_global", (236, 90), "VOUT"),
+    ("text", "no_connect", (292, 98), "X"),
+    ("rect", "sheet_background", (240, 132, 300, 166)),
+    ("frame", "sheet", (240, 132, 300, 166), 1),
+    ("text", "sheet_name", (240, 122), "SUB"),
+    ("rect", "bus", (30, 178, 290, 182)),
+    ("text", "net_name", (30, 168), "D0..7"),
+    ("rect", "cursor", (272, 29, 289, 30)),
+    ("rect", "cursor", (280, 21, 281, 38)),
+]
+
+MOCKUPS = {
+    "board": BOARD_MOCKUP,
+    "schematic": SCHEMATIC_MOCKUP,
+    # the footprint editor shows the same layers as the board editor
+    "fpedit": BOARD_MOCKUP,
+}
+
+
+class Canvas:
+    # one pixel buffer per process which is reused for every sheet, it only grows when a sheet is taller
+
+    def __init__(self):
+        self.buffer = np.empty((0, SHEET_WIDTH, 3), dtype=np.uint8)
+
+    def frame(self, width, height):
+        if self.buffer.shape[0] < height or self.buffer.shape[1] < width:
+            self.buffer = np.empty((max(height, self.buffer.shape[0]), max(width, self.buffer.shape[1]), 3), dtype=np.uint8)
+        return self.buffer[:height, :width]
+
+
+CANVAS = Canvas()
+
+
+@functools.lru_cache(maxsize=None)
+def glyph(char):
+    bits = FONT.get(char, FONT["?"])
+    rows = [int(bits[i:i + 2], 16) for i in range(0, len(bits), 2)]
+    return np.array([[row >> (GLYPH_WIDTH - 1 - x) & 1 for x in range(GLYPH_WIDTH)] for row in rows], dtype=bool)
+
+
+@functools.lru_cache(maxsize=4096)
+def text_mask(text, scale=1):
+    # the font only has upper case letters, glyphs are one pixel apart
+    spacing = np.zeros((GLYPH_HEIGHT, 1), dtype=bool)
+    columns = [part for char in text.upper() for part in (glyph(char), spacing)]
+    mask = np.hstack(columns[:-1]) if columns else np.zeros((GLYPH_HEIGHT, 0), dtype=bool)
+    return np.repeat(np.repeat(mask, scale, axis=0), scale, axis=1)
+
+
+def text_width(text, scale=1):
+    return max(0, len(text) * (GLYPH_WIDTH + 1) - 1) * scale
+
+
+def paint(view, color, mask=None):
+    # fills view, or the pixels of view selected by mask, with the color blended by its alpha
+    red, green, blue, alpha = kicad_color.unpack(color)
+    rgb = np.array([red, green, blue], dtype=np.uint16)
+    if alpha == 255:
+        if mask is None:
+            view[...] = rgb
+        else:
+            view[mask] = rgb
+        return
+
+    target = view if mask is None else view[mask]
+    blended = (target.astype(np.uint16) * (255 - alpha) + rgb * alpha + 127) // 255
+    if mask is None:
+        view[...] = blended
+    else:
+        view[mask] = blended
+
+
+def fill_rect(canvas, box, color):
+    x0, y0, x1, y1 = box
+    paint(canvas[max(0, y0):y1, max(0, x0):x1], color)
+
+
+def draw_frame(canvas, box, color, width=1):
+    x0, y0, x1, y1 = box
+    fill_rect(canvas, (x0, y0, x1, y0 + width), color)
+    fill_rect(canvas, (x0, y1 - width, x1, y1), color)
+    fill_rect(canvas, (x0, y0 + width, x0 + width, y1 - width), color)
+    fill_rect(canvas, (x1 - width, y0 + width, x1, y1 - width), color)
+
+
+def fill_circle(canvas, center, color):
+    x, y, radius = center
+    view = canvas[max(0, y - radius):y + radius + 1, max(0, x - radius):x + radius + 1]
+    ys, xs = np.ogrid[max(0, y - radius) - y:max(0, y - radius) - y + view.shape[0],
+                      max(0, x - radius) - x:max(0, x - radius) - x + view.shape[1]]
+    paint(view, color, xs * xs + ys * ys <= radius * radius)
+
+
+def draw_text(canvas, position, text, color, scale=1):
+    x, y = position
+    mask = text_mask(text, scale)
+    view = canvas[y:y + mask.shape[0], x:x + mask.shape[1]]
+    paint(view, color, mask[:view.shape[0], :view.shape[1]])
+
+
+def fit_text(text, width):
+    length = (width + 1) // (GLYPH_WIDTH + 1)
+    return text if len(text) <= length else text[:max(0, length - 2)] + ".."
+
+
+def section_colors(palette, section):
+    prefix = f"{section}."
+    return {key[len(prefix):]: color for key, color in palette.items() if key.startswith(prefix)}
+
+
+def draw_mockup(canvas, shapes, colors):
+    background = colors.get("background", SHEET_BACKGROUND)
+    paint(canvas, background)
+    for kind, keys, geometry, *extra in shapes:
+        key = next((key for key in ((keys,) if isinstance(keys, str) else keys) if key in colors), None)
+        if key is None:
+            continue
+        color = colors[key]
+        if kind == "rect":
+            fill_rect(canvas, geometry, color)
+        elif kind == "frame":
+            draw_frame(canvas, geometry, color, *extra)
+        elif kind == "circle":
+            fill_circle(canvas, geometry, color)
+        elif kind == "text":
+            draw_text(canvas, geometry, extra[0], color)
+        elif kind == "dots":
+            paint(canvas[geometry // 2::geometry, geometry // 2::geometry], color)
+
+
+def draw_swatches(canvas, top, colors):
+    # every color as a small square over the background of its section, so transparent colors look like in KiCad
+    background = colors.get("background", SHEET_BACKGROUND)
+    for i, (key, color) in enumerate(colors.items()):
+        x = MARGIN + (i % COLUMNS) * CELL_WIDTH
+        y = top + (i // COLUMNS) * CELL_HEIGHT
+        fill_rect(canvas, (x, y, x + SWATCH_SIZE, y + SWATCH_SIZE), background)
+        fill_rect(canvas, (x + 2, y + 2, x + SWATCH_SIZE - 2, y + SWATCH_SIZE - 2), color)
+        draw_frame(canvas, (x, y, x + SWATCH_SIZE, y + SWATCH_SIZE), SHEET_TEXT)
+        label_x = x + SWATCH_SIZE + 4
+        draw_text(canvas, (label_x, y + (SWATCH_SIZE - GLYPH_HEIGHT) // 2), fit_text(key, x + CELL_WIDTH - 4 - label_x), SHEET_TEXT)
+
+
+def sheet_height(sections):
+    height = MARGIN + 2 * GLYPH_HEIGHT + MARGIN
+    if sections:
+        height += MOCKUP_HEIGHT + 4 + GLYPH_HEIGHT + MARGIN
+    for colors in sections.values():
+        height += GLYPH_HEIGHT + 4 + -(-len(colors) // COLUMNS) * CELL_HEIGHT + MARGIN
+    return height
+
+
+def render_sheet(title, palette):
+    # returns the preview as PNG, a title, a mockup for every section of the theme and all its colors
+    sections = {section: colors for section in kicad_color.PALETTE_SECTIONS if (colors := section_colors(palette, section))}
+    height = sheet_height(sections)
+    canvas = CANVAS.frame(SHEET_WIDTH, height)
+    paint(canvas, SHEET_BACKGROUND)
+
+    draw_text(canvas, (MARGIN, MARGIN), fit_text(title, (SHEET_WIDTH - 2 * MARGIN) // 2), SHEET_TEXT, scale=2)
+    top = MARGIN + 2 * GLYPH_HEIGHT + MARGIN
+
+    if sections:
+        for i, (section, colors) in enumerate(sections.items()):
+            x = MARGIN + i * (MOCKUP_WIDTH + MOCKUP_GAP)
+            draw_mockup(canvas[top:top + MOCKUP_HEIGHT, x:x + MOCKUP_WIDTH], MOCKUPS[section], colors)
+            draw_text(canvas, (x, top + MOCKUP_HEIGHT + 4), section, SHEET_TEXT)
+        top += MOCKUP_HEIGHT + 4 + GLYPH_HEIGHT + MARGIN
+
+    for section, colors in sections.items():
+        draw_text(canvas, (MARGIN, top), f"{section} ({len(colors)} colors)", SHEET_TEXT)
+        top += GLYPH_HEIGHT + 4
+        draw_swatches(canvas, top, colors)
+        top += -(-len(colors) // COLUMNS) * CELL_HEIGHT + MARGIN
+
+    return png_writer.encode_png(SHEET_WIDTH, height, canvas.tobytes())
+
+
+def palette_sha256(title, palette):
+    # identifies the rendered sheet, themes with the same name and colors share their preview
+    palette_str = ";".join(f"{key}={color:08x}" for key, color in palette.items())
+    return hashlib.sha256(f"{RENDERER_VERSION};{title};{palette_str}".encode("utf-8")).hexdigest()
+
+
+def create_preview(theme_dir, force=False):
+    # returns the written preview, None if it was up to date or the theme cannot be loaded
+    theme_file = find_theme_json(theme_dir)
+    if theme_file is None:
+        return None
+    try:
+        theme_files = theme_resolver.theme_chain(theme_file)
+        preview_file = theme_dir / PREVIEW_FILENAME
+        if not force and is_up_to_date(preview_file, *theme_files):
+            return None
+        theme_json = theme_resolver.load_theme(theme_file)
+        palette = kicad_color.Palette.from_theme(theme_json)
+    except ValueError as e:
+        print(f"cannot load {theme_file}, {e}")
+        return None
+
+    title = theme_json.get("meta", {}).get("name", theme_dir.name)
+    cached_png = PREVIEW_CACHE_PATH / f"{palette_sha256(title, palette)}.png"
+    if cached_png.exists():
+        png_data = cached_png.read_bytes()
+    else:
+        png_data = render_sheet(title, palette)
+        PREVIEW_CACHE_PATH.mkdir(exist_ok=True)
+        # workers rendering the same palette at the same time must not see a partial file
+        atomic_file.write_file_atomic(cached_png, png_data)
+
+    if preview_file.exists() and preview_file.read_bytes() == png_data:
+        preview_file.touch()
+        return None
+
+    print(f'create {PREVIEW_FILENAME} for {theme_dir}')
+    atomic_file.write_file_atomic(preview_file, png_data)
+    return preview_file
+
+
+def create_all_previews(theme_dirs, jobs=1, force=False):
+    theme_dirs = [theme_dir for theme_dir in theme_dirs if find_theme_json(theme_dir) is not None]
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(create_preview, theme_dirs, [force] * len(theme_dirs)))
+    else:
+        results = [create_preview(theme_dir, force) for theme_dir in theme_dirs]
+    return [preview_file for preview_file in results if preview_file is not None]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=f'Render a {PREVIEW_FILENAME} with editor mockups and all colors of a color scheme (requires numpy)')
+    parser.add_argument('theme_dir', type=Path, nargs='*')
+    parser.add_argument('--all', action='store_true', help='Render previews for all themes of this repository')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes used to render previews')
+    parser.add_argument('--force', action='store_true', help='Render previews even if they are up to date')
+
+    args = parser.parse_args()
+
+    if args.all:
+        theme_dirs = theme_resolver.theme_dirs(ROOT_PATH)
+    elif args.theme_dir:
+        theme_dirs = args.theme_dir
+    else:
+        parser.error("either a theme_dir or --all is required")
+
+    start = time.perf_counter()
+    created = create_all_previews(theme_dirs, max(1, args.jobs), args.force)
+    print(f"* {len(created)} previews created in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import email.utils
+import hashlib
+import json
+import re
+import urllib.parse
+
+from pathlib import Path
+
+from create_repository import ROOT_PATH, PACKAGES_JSON_PATH, REPOSITORY_JSON_PATH, RESOURCES_PATH, PACKAGE_SHARDS_PATH, READ_SIZE
+
+# only repository files are served, never anything else of the working tree
+SERVED_PATH_REGEX = re.compile(r"^(repository\.json|packages\.json(\.gz)?|resources\.zip"
+                               r"|package_shards/[-a-zA-Z0-9._]+\.json(\.gz)?"
+                               r"|[-a-zA-Z0-9._]+/[-a-zA-Z0-9._]+_pcm\.zip)$")
+
+CONTENT_TYPES = {
+    ".json": "application/json",
+    ".zip": "application/zip",
+    ".gz": "application/gzip",
+}
+
+RANGE_REGEX = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+MAX_HEADER_SIZE = 16384
+
+
+class RepositoryIndex:
+    # sha256 of the served files, taken from repository.json and packages.json wherever they are already known
+
+    def __init__(self, root_path=ROOT_PATH):
+        self.root_path = root_path
+        self.index_stamp = None
+        self.known = {}
+        self.computed = {}
+
+    def stamp_of(self, path):
+        try:
+            stat = path.stat()
+            return stat.st_size, stat.st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def reload(self):
+        repository_json_path = self.root_path / REPOSITORY_JSON_PATH.name
+        packages_json_path = self.root_path / PACKAGES_JSON_PATH.name
+        stamp = (self.stamp_of(repository_json_path), self.stamp_of(packages_json_path))
+        if stamp == self.index_stamp:
+            return
+        self.index_stamp = stamp
+
+        known = {}
+        try:
+            repository = json.loads(repository_json_path.read_bytes())
+            for key, filename in (("packages", PACKAGES_JSON_PATH.name), ("resources", RESOURCES_PATH.name)):
+                if key in repository:
+                    known[filename] = repository[key]["sha256"]
+            for shard in repository.get("package_shards", []):
+                known[f"{PACKAGE_SHARDS_PATH.name}/{shard['identifier']}.json"] = shard["sha256"]
+
+            packages = json.loads(packages_json_path.read_bytes())
+            for package in packages["packages"]:
+                for version in package["versions"]:
+                    url_path = urllib.parse.urlparse(version["download_url"]).path
+                    relative = "/".join(url_path.split("/")[-2:])
+                    known[relative] = version["download_sha256"]
+        except (OSError, ValueError, KeyError):
+            pass
+        self.known = known
+
+    def etag(self, relative, path, stat):
+        self.reload()
+        sha256 = self.known.get(relative)
+        if sha256 is None:
+            # e.g. repository.json itself, hashed once per size and mtime
+            stamp = (stat.st_size, stat.st_mtime_ns)
+            cached = self.computed.get(relative)
+            if cached is None or cached[0] != stamp:
+                file_hash = hashlib.sha256()
+                with path.open("rb") as f:
+                    for data in iter(lambda: f.read(READ_SIZE), b""):
+                        file_hash.update(data)
+                cached = (stamp, file_hash.hexdigest())
+                self.computed[relative] = cached
+            sha256 = cached[1]
+        return f'"{sha256}"'
+
+
+def parse_range(range_header, size):
+    # returns (start, end) inclusive, None to serve the whole file, or False if the range is not satisfiable
+    match = RANGE_REGEX.match(range_header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+
+    first, last = match.groups()
+    if first == "":
+        length = int(last)
+        if length == 0:
+            return False
+        return max(0, size - length), size - 1
+
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def etag_matches(if_none_match, etag):
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+class RepositoryServer:
+    def __init__(self, root_path=ROOT_PATH):
+        self.root_path = root_path.resolve()
+        self.index = RepositoryIndex(self.root_path)
+
+    async def handle(self, reader, writer):
+        try:
+            while await self.handle_request(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        head = await reader.readuntil(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ")
+        except ValueError:
+            return None
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                key, value = line.split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+        return method, target, version, headers
+
+    def write_head(self, writer, status, reason, headers):
+        lines = [f"HTTP/1.1 {status} {reason}"]
+        lines.extend(f"{key}: {value}" for key, value in headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    async def respond_error(self, writer, status, reason, keep_alive, extra_headers=None):
+        body = f"{status} {reason}\n".encode()
+        headers = {"Content-Type": "text/plain", "Content-Length": len(body),
+                   "Connection": "keep-alive" if keep_alive else "close"}
+        headers.update(extra_headers or {})
+        self.write_head(writer, status, reason, headers)
+        writer.write(body)
+        await writer.drain()
+        return keep_alive
+
+    def resolve(self, target):
+        relative = urllib.parse.unquote(urllib.parse.urlsplit(target).path).lstrip("/")
+        if not SERVED_PATH_REGEX.match(relative) or ".." in relative.split("/"):
+            return None, None
+        path = self.root_path / relative
+        if not path.is_file():
+            return None, None
+        return relative, path
+
+    async def handle_request(self, reader, writer):
+        request = await self.read_request(reader)
+        if request is None:
+            return await self.respond_error(writer, 400, "Bad Request", False)
+        method, target, version, headers = request
+        keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+
+        if method not in ("GET", "HEAD"):
+            return await self.respond_error(writer, 405, "Method Not Allowed", keep_alive, {"Allow": "GET, HEAD"})
+
+        relative, path = self.resolve(target)
+        if path is None:
+            return await self.respond_error(writer, 404, "Not Found", keep_alive)
+
+        stat = path.stat()
+        etag = self.index.etag(relative, path, stat)
+        response_headers = {
+            "ETag": etag,
+            "Last-Modified": email.utils.formatdate(stat.st_mtime, usegmt=True),
+            "Accept-Ranges": "bytes",
+            "Content-Type": CONTENT_TYPES.get(path.suffix, "application/octet-stream"),
+            "Connection": "keep-alive" if keep_alive else "close",
+        }
+
+        if "if-none-match" in headers and etag_matches(headers["if-none-match"], etag):
+            self.write_head(writer, 304, "Not Modified", response_headers)
+            await writer.drain()
+            return keep_alive
+
+        status, reason = 200, "OK"
+        offset, count = 0, stat.st_size
+        if "range" in headers and ("if-range" not in headers or headers["if-range"] == etag):
+            byte_range = parse_range(headers["range"], stat.st_size)
+            if byte_range is False:
+                return await self.respond_error(writer, 416, "Range Not Satisfiable", keep_alive,
+                                                {"Content-Range": f"bytes */{stat.st_size}"})
+            if byte_range is not None:
+                status, reason = 206, "Partial Content"
+                offset, count = byte_range[0], byte_range[1] - byte_range[0] + 1
+                response_headers["Content-Range"] = f"bytes {byte_range[0]}-{byte_range[1]}/{stat.st_size}"
+
+        response_headers["Content-Length"] = count
+        self.write_head(writer, status, reason, response_headers)
+        await writer.drain()
+
+        if method == "GET" and count:
+            # sendfile is zero-copy where the platform supports it, asyncio falls back to reading otherwise
+            with path.open("rb") as f:
+                await asyncio.get_running_loop().sendfile(writer.transport, f, offset, count)
+        return keep_alive
+
+
+async def start_server(root_path=ROOT_PATH, host="127.0.0.1", port=8000):
+    server = RepositoryServer(root_path)
+    return await asyncio.start_server(server.handle, host, port, limit=MAX_HEADER_SIZE)
+
+
+async def serve(root_path, host, port):
+    server = await start_server(root_path, host, port)
+    for sock in server.sockets:
+        host, port = sock.getsockname()[:2]
+        print(f"serving {root_path} on http://{host}:{port}/repository.json")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the PCM repository over HTTP with ETag and range support')
+    parser.add_argument('--host', type=str, default="127.0.0.1", help='Address to listen on')
+    parser.add_argument('-p', '--port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('--root', type=Path, default=ROOT_PATH, help='Repository directory to serve')
+
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.root, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import asyncio
+
+import serve_repository
+import verify_repository
+from create_repository import ROOT_PATH, REPOSITORY_JSON_PATH, REPOSITORY_BASE_URI
+
+
+async def request(reader, writer, path, headers=None):
+    # one request on a keep-alive connection, returns the status, headers and body
+    lines = [f"GET {path} HTTP/1.1", "Host: 127.0.0.1"]
+    lines.extend(f"{key}: {value}" for key, value in (headers or {}).items())
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+    await writer.drain()
+
+    head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+    response_headers = {}
+    for line in head[1:]:
+        if ":" in line:
+            key, value = line.split(":", 1)
+            response_headers[key.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(response_headers.get("content-length", 0)))
+    return int(head[0].split(" ")[1]), response_headers, body
+
+
+async def serve_and_verify():
+    server = await serve_repository.start_server(ROOT_PATH, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    async with server:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            repository_json = (ROOT_PATH / REPOSITORY_JSON_PATH.name).read_bytes()
+            path = f"/{REPOSITORY_JSON_PATH.name}"
+
+            status, headers, body = await request(reader, writer, path)
+            assert status == 200 and body == repository_json
+
+            status, _, body = await request(reader, writer, path, {"If-None-Match": headers["etag"]})
+            assert status == 304 and body == b""
+
+            status, headers, body = await request(reader, writer, path, {"Range": "bytes=0-9"})
+            assert status == 206 and body == repository_json[:10]
+            assert headers["content-range"] == f"bytes 0-9/{len(repository_json)}"
+
+            status, headers, _ = await request(reader, writer, path, {"Range": f"bytes={len(repository_json)}-"})
+            assert status == 416 and headers["content-range"] == f"bytes */{len(repository_json)}"
+
+            status, _, _ = await request(reader, writer, "/create_repository.py")
+            assert status == 404
+        finally:
+            writer.close()
+
+        source = verify_repository.HttpSource(f"http://127.0.0.1:{port}", REPOSITORY_BASE_URI)
+        verifier = await verify_repository.verify_repository(source, REPOSITORY_BASE_URI, jobs=2)
+    return verifier, source
+
+
+def test_serve_and_verify_repository():
+    verifier, source = asyncio.run(serve_and_verify())
+    assert verifier.mismatches == []
+    # every file is fetched over the keep-alive connections of the two jobs
+    assert 0 < source.connections < verifier.files
@@ -0,0 +1,155 @@
+import json
+
+# a theme json can set "base" in its "meta" section to the directory name of another theme of the repository,
+# it then only needs the keys which differ from it. KiCad itself does not know about this, so packages and
+# installed themes always contain the resolved theme
+
+METADATA_FILEAME = "metadata.json"
+BASE_KEY = "base"
+PACKAGE_SHARDS_DIRNAME = "package_shards"
+
+# directories next to the themes which are written by the tools, they never contain a theme
+GENERATED_DIRS = {PACKAGE_SHARDS_DIRNAME, "__pycache__"}
+
+
+def is_theme_dir_name(path):
+    # also works for directories which were removed, e.g. for the events of --watch
+    return not path.name.startswith(".") and path.name not in GENERATED_DIRS
+
+
+def theme_dirs(root_path):
+    # every directory of the repository which may hold a theme, sorted by name
+    return sorted(path for path in root_path.iterdir() if path.is_dir() and is_theme_dir_name(path))
+
+
+def find_theme_json(theme_dir):
+    for theme_file in sorted(theme_dir.glob("*.json")):
+        if theme_file.name != METADATA_FILEAME:
+            return theme_file
+    return None
+
+
+def stamp_of(path):
+    stat = path.stat()
+    return stat.st_mtime_ns, stat.st_size
+
+
+def merge(base, overrides):
+    # nested sections are merged key by key, everything else of overrides replaces the value of base
+    merged = dict(base)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+class ResolvedTheme:
+    __slots__ = ('theme', 'chain', 'stamps', '_data')
+
+    def __init__(self, theme, chain, stamps):
+        self.theme = theme
+        # theme files this one is made of, itself first
+        self.chain = chain
+        self.stamps = stamps
+        self._data = None
+
+    def data(self):
+        # the file content for themes without base, so they are packaged and installed byte for byte
+        if self._data is None:
+            if len(self.chain) == 1:
+                self._data = self.chain[0].read_bytes()
+            else:
+                self._data = json.dumps(self.theme, sort_keys=True, indent=2).encode("utf-8")
+        return self._data
+
+
+class ThemeResolver:
+    # resolved themes are memoized, and are resolved again when any file of their chain changed
+
+    def __init__(self):
+        self.parsed = {}
+        self.resolved = {}
+
+    def load(self, theme_file, stamp):
+        cached = self.parsed.get(theme_file)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        with theme_file.open("rb") as f:
+            theme = json.load(f)
+        if not isinstance(theme, dict):
+            raise ValueError(f"{theme_file} is no theme")
+        self.parsed[theme_file] = (stamp, theme)
+        return theme
+
+    def is_valid(self, resolved):
+        try:
+            return all(stamp_of(path) == stamp for path, stamp in zip(resolved.chain, resolved.stamps))
+        except FileNotFoundError:
+            return False
+
+    def resolve(self, theme_file):
+        # returns the ResolvedTheme, raises ValueError for unknown bases and cycles
+        theme_file = theme_file.resolve()
+        cached = self.resolved.get(theme_file)
+        if cached is not None and self.is_valid(cached):
+            return cached
+
+        stamp = stamp_of(theme_file)
+        own = self.load(theme_file, stamp)
+        base_name = own.get("meta", {}).get(BASE_KEY)
+        if base_name is not None and not isinstance(base_name, str):
+            raise ValueError(f"{theme_file.name}: base theme has to be the name of a theme directory")
+        if base_name is None:
+            resolved = ResolvedTheme(own, (theme_file,), (stamp,))
+        else:
+            base_file = find_theme_json(theme_file.parent.parent / base_name)
+            if base_file is None or not base_file.parent.parent.samefile(theme_file.parent.parent):
+                raise ValueError(f"{theme_file.name}: base theme '{base_name}' does not exist")
+            if base_file.resolve() == theme_file:
+                raise ValueError(f"{theme_file.name}: theme cannot be its own base")
+
+            self.resolved[theme_file] = None
+            try:
+                base = self.resolve_checked(base_file, theme_file)
+            finally:
+                self.resolved.pop(theme_file, None)
+
+            theme = merge(base.theme, own)
+            theme["meta"] = {key: value for key, value in own.get("meta", {}).items() if key != BASE_KEY}
+            resolved = ResolvedTheme(theme, (theme_file,) + base.chain, (stamp,) + base.stamps)
+
+        self.resolved[theme_file] = resolved
+        return resolved
+
+    def resolve_checked(self, base_file, theme_file):
+        # themes which are being resolved are marked with None
+        if base_file.resolve() in self.resolved and self.resolved[base_file.resolve()] is None:
+            raise ValueError(f"{theme_file.name}: cycle of base themes at {base_file.name}")
+        return self.resolve(base_file)
+
+    def theme(self, theme_file):
+        # the resolved theme is shared by all callers, it must not be modified
+        return self.resolve(theme_file).theme
+
+    def data(self, theme_file):
+        return self.resolve(theme_file).data()
+
+    def chain(self, theme_file):
+        return self.resolve(theme_file).chain
+
+
+RESOLVER = ThemeResolver()
+
+
+def load_theme(theme_file):
+    return RESOLVER.theme(theme_file)
+
+
+def theme_data(theme_file):
+    return RESOLVER.data(theme_file)
+
+
+def theme_chain(theme_file):
+    return RESOLVER.chain(theme_file)
@@ -0,0 +1,159 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+# file system events of the theme directories, inotify on Linux and polling everywhere else
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+ROOT_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+THEME_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 65536
+
+DEFAULT_POLL_INTERVAL = 0.5
+
+
+def load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class InotifyWatcher:
+    def __init__(self, root_path, libc):
+        self.root_path = root_path
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+
+        self.add_watch(root_path, ROOT_MASK)
+        for path in root_path.iterdir():
+            if path.is_dir():
+                self.add_watch(path, THEME_MASK)
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            # e.g. the directory was removed again in the meantime
+            return
+        self.watches[wd] = path
+
+    def changes(self, timeout):
+        # paths changed within timeout seconds, an empty list if nothing happened
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+
+        changed = []
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return changed
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+
+                directory = self.watches.get(wd)
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                if directory is None or not name:
+                    continue
+
+                path = directory / name
+                if directory == self.root_path:
+                    # files at the top level like packages.json are written by the build itself
+                    if not mask & IN_ISDIR:
+                        continue
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self.add_watch(path, THEME_MASK)
+                changed.append(path)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    def __init__(self, root_path, interval=DEFAULT_POLL_INTERVAL):
+        self.root_path = root_path
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for theme_dir in self.root_path.iterdir():
+            if not theme_dir.is_dir():
+                continue
+            # directories are part of the snapshot, so added and removed themes are noticed
+            snapshot[theme_dir] = ()
+            try:
+                with os.scandir(theme_dir) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            stat = entry.stat()
+                            snapshot[theme_dir / entry.name] = (stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                pass
+        return snapshot
+
+    def changes(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            snapshot = self.scan()
+            changed = [path for path in snapshot.keys() | self.snapshot.keys() if snapshot.get(path) != self.snapshot.get(path)]
+            self.snapshot = snapshot
+            remaining = deadline - time.monotonic()
+            if changed or remaining <= 0:
+                return changed
+            time.sleep(min(self.interval, remaining))
+
+    def close(self):
+        pass
+
+
+def create_watcher(root_path, polling=False, interval=DEFAULT_POLL_INTERVAL):
+    libc = None if polling else load_libc()
+    if libc is not None:
+        try:
+            return InotifyWatcher(root_path, libc)
+        except OSError:
+            pass
+    return PollingWatcher(root_path, interval)
+
+
+def changed_theme_dirs(watcher, root_path, is_source, debounce):
+    # blocks until a source file changed, then collects further changes until it is quiet for debounce seconds
+    theme_dirs = set()
+    while True:
+        changes = watcher.changes(debounce if theme_dirs else 3600)
+        relevant = {root_path / path.relative_to(root_path).parts[0]
+                    for path in changes if path.parent == root_path or is_source(path)}
+        if not relevant and theme_dirs:
+            return theme_dirs
+        theme_dirs |= relevant
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import re
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import kicad_color
+import theme_resolver
+from create_icon import ROOT_PATH, EESCHEMA_REPLACEMENT_TABLE, PCBNEW_REPLACEMENT_TABLE, find_theme_json
+
+METADATA_FILEAME = "metadata.json"
+
+# subset of the PCM package schema (https://go.kicad.org/pcm/schemas/v1) the repository relies on
+METADATA_SCHEMA = {
+    "$schema": str,
+    "name": str,
+    "description": str,
+    "description_full": str,
+    "identifier": str,
+    "type": str,
+    "author": dict,
+    "maintainer": dict,
+    "license": str,
+    "versions": list,
+}
+VERSION_SCHEMA = {
+    "version": str,
+    "status": str,
+    "kicad_version": str,
+}
+THEME_META_SCHEMA = {
+    "filename": str,
+    "name": str,
+    "version": int,
+}
+
+IDENTIFIER_REGEX = re.compile(r"^[a-zA-Z][-a-zA-Z0-9._]{0,98}[a-zA-Z0-9]$")
+VERSION_REGEX = re.compile(r"^\d{1,4}(\.\d{1,4}(\.\d{1,6})?)?$")
+KICAD_VERSION_REGEX = re.compile(r"^\d{1,2}(\.\d{1,2}(\.\d{1,2})?)?$")
+VERSION_STATUS = {"stable", "testing", "development", "deprecated"}
+
+# colors create_icon.py needs to render the icons of a theme
+ICON_KEYS = {
+    "schematic": sorted(set(EESCHEMA_REPLACEMENT_TABLE.values())),
+    "board": sorted(set(PCBNEW_REPLACEMENT_TABLE.values()) - {"copper_f", "copper_b"} | {"copper.f", "copper.b"}),
+}
+
+
+class ValidationResult:
+    def __init__(self, path):
+        self.path = path
+        self.identifier = None
+        self.errors = []
+        self.warnings = []
+
+
+def check_schema(data, schema, where, errors):
+    if not isinstance(data, dict):
+        errors.append(f"{where} is no object")
+        return False
+    for key, value_type in schema.items():
+        if key not in data:
+            errors.append(f"{where} misses '{key}'")
+        elif not isinstance(data[key], value_type):
+            errors.append(f"{where}: '{key}' is no {value_type.__name__}")
+    return True
+
+
+def load_json(path, errors):
+    try:
+        with path.open("rb") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        errors.append(f"{path.name} cannot be loaded: {e}")
+        return None
+
+
+def validate_metadata(metadata_path, result):
+    metadata = load_json(metadata_path, result.errors)
+    if metadata is None or not check_schema(metadata, METADATA_SCHEMA, metadata_path.name, result.errors):
+        return
+
+    identifier = metadata.get("identifier")
+    if isinstance(identifier, str):
+        result.identifier = identifier
+        if not IDENTIFIER_REGEX.match(identifier):
+            result.errors.append(f"{metadata_path.name}: invalid identifier '{identifier}'")
+
+    versions = metadata.get("versions")
+    if isinstance(versions, list):
+        if not versions:
+            result.errors.append(f"{metadata_path.name}: 'versions' is empty")
+        seen = set()
+        for i, version in enumerate(versions):
+            where = f"{metadata_path.name}: versions[{i}]"
+            if not check_schema(version, VERSION_SCHEMA, where, result.errors):
+                continue
+            if isinstance(version.get("version"), str):
+                if not VERSION_REGEX.match(version["version"]):
+                    result.errors.append(f"{where}: invalid version '{version['version']}'")
+                if version["version"] in seen:
+                    result.errors.append(f"{where}: duplicate version '{version['version']}'")
+                seen.add(version["version"])
+            if isinstance(version.get("status"), str) and version["status"] not in VERSION_STATUS:
+                result.errors.append(f"{where}: invalid status '{version['status']}'")
+            if isinstance(version.get("kicad_version"), str) and not KICAD_VERSION_REGEX.match(version["kicad_version"]):
+                result.errors.append(f"{where}: invalid kicad_version '{version['kicad_version']}'")
+
+
+def validate_theme(theme_file, result):
+    # themes based on another one are validated as the resolved theme which is packaged
+    if load_json(theme_file, result.errors) is None:
+        return
+    try:
+        theme = theme_resolver.load_theme(theme_file)
+    except (OSError, ValueError) as e:
+        result.errors.append(f"{theme_file.name} cannot be resolved: {e}")
+        return
+
+    check_schema(theme.get("meta"), THEME_META_SCHEMA, f"{theme_file.name}: meta", result.errors)
+
+    for section in kicad_color.PALETTE_SECTIONS:
+        if section not in theme:
+            continue
+        flat = dict(kicad_color.flatten_section(theme[section]))
+        for key, value in flat.items():
+            # flags like override_item_colors are no colors
+            if isinstance(value, bool):
+                continue
+            if not kicad_color.is_color(value):
+                result.errors.append(f"{theme_file.name}: {section}.{key} is no color: {value!r}")
+
+        missing = [key for key in ICON_KEYS.get(section, []) if key not in flat]
+        if missing:
+            result.warnings.append(f"{theme_file.name}: no {section} icon, missing {', '.join(missing)}")
+
+    if not any(section in theme for section in kicad_color.PALETTE_SECTIONS):
+        result.errors.append(f"{theme_file.name} has none of {', '.join(kicad_color.PALETTE_SECTIONS)}")
+
+
+def validate_theme_dir(path):
+    result = ValidationResult(path)
+
+    metadata_path = path / METADATA_FILEAME
+    if metadata_path.exists():
+        validate_metadata(metadata_path, result)
+
+    theme_file = find_theme_json(path)
+    if theme_file is not None:
+        validate_theme(theme_file, result)
+    elif metadata_path.exists():
+        result.errors.append("no theme .json found")
+
+    return result
+
+
+def validate_all(theme_dirs, jobs=1):
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(validate_theme_dir, theme_dirs))
+    else:
+        results = [validate_theme_dir(path) for path in theme_dirs]
+
+    # identifiers have to be unique across all packages
+    owners = {}
+    for result in results:
+        if result.identifier is not None:
+            owners.setdefault(result.identifier, []).append(result)
+    for identifier, duplicates in owners.items():
+        if len(duplicates) > 1:
+            names = ", ".join(result.path.name for result in duplicates)
+            for result in duplicates:
+                result.errors.append(f"identifier '{identifier}' is used by {names}")
+
+    return results
+
+
+def print_results(results, warnings=True):
+    # returns the number of errors
+    error_count = 0
+    for result in results:
+        for error in result.errors:
+            print(f"error: {result.path.name}: {error}")
+        if warnings:
+            for warning in result.warnings:
+                print(f"warning: {result.path.name}: {warning}")
+        error_count += len(result.errors)
+    return error_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Validate theme json and metadata.json files')
+    parser.add_argument('theme_dir', type=Path, nargs='*', help='Theme directories (default: all themes of this repository)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes used for validation')
+    parser.add_argument('-q', '--quiet', action='store_true', help='Do not print warnings')
+
+    args = parser.parse_args()
+
+    theme_dirs = args.theme_dir or theme_resolver.theme_dirs(ROOT_PATH)
+    error_count = print_results(validate_all(theme_dirs, max(1, args.jobs)), not args.quiet)
+    if error_count:
+        print(f"{error_count} errors found")
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import ssl
+import tempfile
+import time
+import urllib.parse
+
+from pathlib import Path
+from zipfile import ZipFile, BadZipFile
+
+from create_repository import ROOT_PATH, REPOSITORY_JSON_PATH, REPOSITORY_BASE_URI, READ_SIZE
+
+DEFAULT_JOBS = 8
+MAX_REDIRECTS = 5
+# downloads up to this size are kept in memory to read the install size, larger ones are spooled to disk
+SPOOL_SIZE = 4 * 1024 * 1024
+MAX_HEADER_SIZE = 16384
+
+
+class FetchError(Exception):
+    pass
+
+
+class Download:
+    # sha256 and size of a streamed file, the data itself is only kept when it is needed afterwards
+
+    def __init__(self, keep=False):
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) if keep else None
+
+    def update(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        if self.spool is not None:
+            self.spool.write(data)
+
+    def sha256(self):
+        return self.hash.hexdigest()
+
+    def data(self):
+        self.spool.seek(0)
+        return self.spool.read()
+
+    def install_size(self):
+        self.spool.seek(0)
+        with ZipFile(self.spool, 'r') as zip:
+            return sum(info.file_size for info in zip.infolist())
+
+    def close(self):
+        if self.spool is not None:
+            self.spool.close()
+
+
+def relative_url(url, base_uri):
+    prefix = base_uri.rstrip("/") + "/"
+    if not url.startswith(prefix):
+        raise FetchError(f"not below the base uri {base_uri}")
+    return url[len(prefix):]
+
+
+class LocalSource:
+    # resolves the published URLs to files of a repository directory
+
+    def __init__(self, root_path, base_uri):
+        self.root_path = root_path.resolve()
+        self.base_uri = base_uri
+
+    def describe(self):
+        return str(self.root_path)
+
+    def path_of(self, url):
+        relative = urllib.parse.unquote(relative_url(url, self.base_uri))
+        if ".." in relative.split("/"):
+            raise FetchError("outside of the repository")
+        return self.root_path / relative
+
+    async def fetch(self, url, download):
+        path = self.path_of(url)
+
+        def read():
+            with path.open("rb") as f:
+                for data in iter(lambda: f.read(READ_SIZE), b""):
+                    download.update(data)
+
+        try:
+            await asyncio.to_thread(read)
+        except FileNotFoundError:
+            raise FetchError(f"{path} does not exist") from None
+        except OSError as e:
+            raise FetchError(f"cannot read {path}, {e}") from None
+
+    async def close(self):
+        pass
+
+
+class HttpConnection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.requests = 0
+
+    def close(self):
+        self.writer.close()
+
+
+class HttpSource:
+    # fetches the published URLs from an HTTP(S) mirror, with keep-alive connections which are reused by all downloads
+
+    def __init__(self, mirror_url, base_uri):
+        self.mirror_url = mirror_url.rstrip("/")
+        self.base_uri = base_uri
+        self.idle = {}
+        self.connections = 0
+        self.ssl_context = None
+
+    def describe(self):
+        return self.mirror_url
+
+    def mirror_url_of(self, url):
+        return f"{self.mirror_url}/{relative_url(url, self.base_uri)}"
+
+    async def connect(self, key):
+        idle = self.idle.get(key)
+        if idle:
+            return idle.pop()
+        scheme, host, port = key
+        if scheme == "https" and self.ssl_context is None:
+            self.ssl_context = ssl.create_default_context()
+        reader, writer = await asyncio.open_connection(host, port, ssl=self.ssl_context if scheme == "https" else None,
+                                                       limit=MAX_HEADER_SIZE)
+        self.connections += 1
+        return HttpConnection(reader, writer)
+
+    def release(self, key, connection):
+        self.idle.setdefault(key, []).append(connection)
+
+    async def fetch(self, url, download):
+        target = self.mirror_url_of(url)
+        for _ in range(MAX_REDIRECTS + 1):
+            location = await self.get(target, download)
+            if location is None:
+                return
+            target = urllib.parse.urljoin(target, location)
+        raise FetchError("too many redirects")
+
+    async def get(self, url, download):
+        # streams the body into download, returns the location of a redirect instead
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise FetchError(f"unsupported url {url}")
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == "https" else 80))
+        path = parts.path or "/"
+        if parts.query:
+            path += f"?{parts.query}"
+        host = parts.netloc.rsplit("@", 1)[-1]
+        request = f"GET {path} HTTP/1.1\r\nHost: {host}\r\nAccept-Encoding: identity\r\nConnection: keep-alive\r\n\r\n"
+
+        while True:
+            try:
+                connection = await self.connect(key)
+            except OSError as e:
+                raise FetchError(f"cannot connect to {parts.netloc}, {e}") from None
+            reused = connection.requests > 0
+            try:
+                connection.writer.write(request.encode("latin-1"))
+                await connection.writer.drain()
+                status, headers = await self.read_head(connection.reader)
+                break
+            except FetchError:
+                connection.close()
+                raise
+            except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+                connection.close()
+                # the server may have closed an idle connection in the meantime, that is worth a new connection
+                if not reused:
+                    raise FetchError(f"connection to {parts.netloc} failed, {e}") from None
+
+        connection.requests += 1
+        is_redirect = status in (301, 302, 303, 307, 308) and "location" in headers
+        try:
+            # the body of errors and redirects is read as well, so the connection can be reused
+            await self.read_body(connection.reader, headers, download if status == 200 else None)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError) as e:
+            connection.close()
+            raise FetchError(f"download failed, {e}") from None
+
+        if headers.get("connection", "").lower() == "close" or not self.is_delimited(headers):
+            connection.close()
+        else:
+            self.release(key, connection)
+
+        if is_redirect:
+            return headers["location"]
+        if status != 200:
+            raise FetchError(f"HTTP {status}")
+        return None
+
+    async def read_head(self, reader):
+        head = await reader.readuntil(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            status = int(lines[0].split(" ")[1])
+        except (IndexError, ValueError):
+            raise FetchError(f"invalid response {lines[0]!r}") from None
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                key, value = line.split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+        return status, headers
+
+    def is_delimited(self, headers):
+        return "content-length" in headers or headers.get("transfer-encoding", "").lower() == "chunked"
+
+    async def read_body(self, reader, headers, download):
+        # download is None to discard the body
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                if size == 0:
+                    # trailers end with an empty line
+                    while await reader.readuntil(b"\r\n") != b"\r\n":
+                        pass
+                    return
+                await self.read_exactly(reader, size, download)
+                await reader.readexactly(2)
+        elif "content-length" in headers:
+            await self.read_exactly(reader, int(headers["content-length"]), download)
+        else:
+            # the body ends when the server closes the connection
+            while data := await reader.read(READ_SIZE):
+                if download is not None:
+                    download.update(data)
+
+    async def read_exactly(self, reader, size, download):
+        while size > 0:
+            data = await reader.read(min(READ_SIZE, size))
+            if not data:
+                raise asyncio.IncompleteReadError(b"", size)
+            size -= len(data)
+            if download is not None:
+                download.update(data)
+
+    async def close(self):
+        for connections in self.idle.values():
+            for connection in connections:
+                connection.close()
+        self.idle = {}
+
+
+class Verifier:
+    # checks the hashes and sizes repository.json and packages.json claim against the files they point to
+
+    def __init__(self, source, base_uri, jobs=DEFAULT_JOBS):
+        self.source = source
+        self.base_uri = base_uri.rstrip("/")
+        self.repository_url = f"{self.base_uri}/{REPOSITORY_JSON_PATH.name}"
+        self.semaphore = asyncio.Semaphore(jobs)
+        self.mismatches = []
+        self.files = 0
+        self.bytes = 0
+
+    def mismatch(self, url, message):
+        self.mismatches.append((url, message))
+
+    def compare(self, url, field, expected, actual):
+        if expected != actual:
+            self.mismatch(url, f"{field} is {expected}, but the file has {actual}")
+
+    async def download(self, url, keep=False):
+        # returns the Download, or None if the file cannot be fetched
+        download = Download(keep)
+        async with self.semaphore:
+            try:
+                await self.source.fetch(url, download)
+            except FetchError as e:
+                download.close()
+                self.mismatch(url, str(e))
+                return None
+        self.files += 1
+        self.bytes += download.size
+        return download
+
+    def has_fields(self, name, entry, fields):
+        # entries of repository.json, a malformed one is reported instead of checked
+        missing = [field for field in fields if not isinstance(entry, dict) or not isinstance(entry.get(field), str)]
+        if missing:
+            self.mismatch(self.repository_url, f"{name} has no valid {', '.join(missing)}")
+        return not missing
+
+    async def verify_index_file(self, name, entry, keep=False):
+        # a file listed in repository.json, e.g. packages.json or resources.zip
+        if not self.has_fields(name, entry, ("url", "sha256")):
+            return None
+        download = await self.download(entry["url"], keep)
+        if download is not None:
+            self.compare(entry["url"], "sha256", entry["sha256"], download.sha256())
+        return download
+
+    async def verify_version(self, identifier, version):
+        url = version.get("download_url")
+        if url is None:
+            return
+        if not isinstance(url, str):
+            self.mismatch(self.repository_url, f"download_url of {identifier} {version.get('version')} is no string")
+            return
+        download = await self.download(url, keep="install_size" in version)
+        if download is None:
+            return
+        try:
+            self.compare(url, "download_sha256", version.get("download_sha256"), download.sha256())
+            self.compare(url, "download_size", version.get("download_size"), download.size)
+            if "install_size" in version:
+                try:
+                    install_size = await asyncio.to_thread(download.install_size)
+                except BadZipFile as e:
+                    self.mismatch(url, f"{identifier} {version.get('version')} is no zip file, {e}")
+                else:
+                    self.compare(url, "install_size", version["install_size"], install_size)
+        finally:
+            download.close()
+
+    async def verify_shard(self, shard, packages):
+        if not self.has_fields("package shard", shard, ("identifier",)):
+            return
+        download = await self.verify_index_file(f"package shard {shard['identifier']}", shard, keep=True)
+        if download is None:
+            return
+        try:
+            if json.loads(download.data()) != packages.get(shard["identifier"]):
+                self.mismatch(shard["url"], f"shard of {shard['identifier']} differs from packages.json")
+        except ValueError as e:
+            self.mismatch(shard["url"], f"invalid json, {e}")
+        finally:
+            download.close()
+
+    def valid_packages(self, url, packages):
+        # packages with an identifier and a list of versions, the others are reported
+        valid = []
+        for i, package in enumerate(packages):
+            if isinstance(package, dict) and isinstance(package.get("identifier"), str) \
+                    and isinstance(package.get("versions"), list) and all(isinstance(v, dict) for v in package["versions"]):
+                valid.append(package)
+            else:
+                self.mismatch(url, f"package {i} has no valid identifier and versions")
+        return valid
+
+    async def verify_packages(self, entry):
+        download = await self.verify_index_file("packages", entry, keep=True)
+        if download is None:
+            return {}
+        try:
+            packages = json.loads(download.data())["packages"]
+            if not isinstance(packages, list):
+                raise TypeError("packages is no list")
+        except (ValueError, KeyError, TypeError) as e:
+            self.mismatch(entry["url"], f"invalid packages.json, {e}")
+            return {}
+        finally:
+            download.close()
+
+        packages = self.valid_packages(entry["url"], packages)
+        await asyncio.gather(*(self.verify_version(package["identifier"], version)
+                               for package in packages for version in package["versions"]))
+        return {package["identifier"]: package for package in packages}
+
+    async def verify(self):
+        download = await self.download(self.repository_url, keep=True)
+        if download is None:
+            return self.mismatches
+        try:
+            repository = json.loads(download.data())
+        except ValueError as e:
+            self.mismatch(self.repository_url, f"invalid json, {e}")
+            return self.mismatches
+        finally:
+            download.close()
+        if not isinstance(repository, dict):
+            self.mismatch(self.repository_url, "is no json object")
+            return self.mismatches
+
+        resources = self.verify_index_file("resources", repository["resources"]) if "resources" in repository else asyncio.sleep(0)
+        packages, resources_download = await asyncio.gather(self.verify_packages(repository.get("packages")), resources)
+        if resources_download is not None:
+            resources_download.close()
+
+        shards = repository.get("package_shards", [])
+        if not isinstance(shards, list):
+            self.mismatch(self.repository_url, "package_shards is no list")
+            shards = []
+        await asyncio.gather(*(self.verify_shard(shard, packages) for shard in shards))
+        return self.mismatches
+
+
+async def verify_repository(source, base_uri, jobs=DEFAULT_JOBS):
+    verifier = Verifier(source, base_uri, jobs)
+    try:
+        await verifier.verify()
+    finally:
+        await source.close()
+    return verifier
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the hashes and sizes of repository.json and packages.json against the published files')
+    parser.add_argument('--root', type=Path, default=ROOT_PATH, help='Repository directory to check (default: this repository)')
+    parser.add_argument('--url', type=str, help='Check the repository served at this HTTP(S) base URL instead of a directory')
+    parser.add_argument('--base_uri', type=str, default=os.environ.get("REPOSITORY_BASE_URI", REPOSITORY_BASE_URI),
+                        help='URI the repository was built for, the URLs of the index are resolved relative to it')
+    parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_JOBS, help='Number of files downloaded and hashed concurrently')
+
+    args = parser.parse_args()
+
+    source = HttpSource(args.url, args.base_uri) if args.url else LocalSource(args.root, args.base_uri)
+    start = time.perf_counter()
+    verifier = asyncio.run(verify_repository(source, args.base_uri, max(1, args.jobs)))
+
+    connections = f" over {source.connections} connections" if args.url else ""
+    print(f"* checked {verifier.files} files ({verifier.bytes} bytes) of {source.describe()}{connections} "
+          f"in {(time.perf_counter() - start) * 1000:.0f} ms")
+    for url, message in sorted(verifier.mismatches):
+        print(f"mismatch: {url}: {message}")
+    if verifier.mismatches:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()